@@ -0,0 +1,135 @@
+import asyncio
+import threading
+from collections import Counter
+from time import monotonic
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import JsonResponse
+
+from .clients import get_client_key
+from .metrics import registry
+from .streaming import ContentTracker, tracking_view
+
+
+POLL_INTERVAL = 0.02
+
+admission_rejected = registry.counter('sofa_admission_rejected_total', 'Requests rejected by the admission control', ('view', 'status'))
+
+
+def get_limits(view):
+    """
+    None when the view isn't limited, (endpoint limit, client limit) otherwise. Limits are for a process:
+    SOFA_ADMISSION_LIMITS maps view names to the requests served at once (None for no limit),
+    SOFA_ADMISSION_CLIENT_LIMIT is the requests of a client served at once by each of those views.
+    """
+    limits = getattr(settings, 'SOFA_ADMISSION_LIMITS', {})
+    if view not in limits:
+        return None
+    return limits[view], getattr(settings, 'SOFA_ADMISSION_CLIENT_LIMIT', None)
+
+
+class AdmissionLimiter:
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.active = Counter()
+        self.active_by_client = Counter()
+
+    def try_acquire(self, view, client_key, limit, client_limit):
+        # None when admitted, the status of the rejection otherwise
+        with self.condition:
+            if client_limit is not None and self.active_by_client[(view, client_key)] >= client_limit:
+                return 429
+            if limit is not None and self.active[view] >= limit:
+                return 503
+            self.active[view] += 1
+            self.active_by_client[(view, client_key)] += 1
+            return None
+
+    def acquire(self, view, client_key, limit, client_limit, timeout):
+        deadline = monotonic() + timeout
+        with self.condition:
+            while True:
+                status = self.try_acquire(view, client_key, limit, client_limit)
+                remaining = deadline - monotonic()
+                if status is None or remaining <= 0:
+                    return status
+                self.condition.wait(remaining)
+
+    async def aacquire(self, view, client_key, limit, client_limit, timeout):
+        # the condition can't be awaited: the event loop polls instead
+        deadline = monotonic() + timeout
+        while True:
+            status = self.try_acquire(view, client_key, limit, client_limit)
+            if status is None or monotonic() >= deadline:
+                return status
+            await asyncio.sleep(POLL_INTERVAL)
+
+    def release(self, view, client_key):
+        with self.condition:
+            self.active[view] -= 1
+            self.active_by_client[(view, client_key)] -= 1
+            if not self.active_by_client[(view, client_key)]:
+                del self.active_by_client[(view, client_key)]
+            self.condition.notify_all()
+
+
+limiter = AdmissionLimiter()
+
+
+class Admission(ContentTracker):
+    def __init__(self, view, client_key):
+        self.view = view
+        self.client_key = client_key
+        self.released = False
+
+    def close(self):
+        # the slot is held until the streaming content is consumed, or until the response is closed (client gone,
+        # errors): both release it, only once
+        with limiter.condition:
+            if self.released:
+                return
+            self.released = True
+            limiter.release(self.view, self.client_key)
+
+
+def get_rejected_response(view, status):
+    admission_rejected.inc(1, view, str(status))
+    if status == 429:
+        body = {"error": "too_many_requests", "reason": "Too many concurrent requests from this client"}
+    else:
+        body = {"error": "service_unavailable", "reason": "The server is busy, retry later"}
+    response = JsonResponse(body, status=status)
+    response['Retry-After'] = str(getattr(settings, 'SOFA_ADMISSION_RETRY_AFTER', 1))
+    return response
+
+
+def get_admission(view, request):
+    limits = get_limits(view)
+    if limits is None:
+        return None
+    client_key = get_client_key(request)
+    status = limiter.acquire(view, client_key, *limits, getattr(settings, 'SOFA_ADMISSION_QUEUE_TIMEOUT', 1))
+    if status is not None:
+        return get_rejected_response(view, status)
+    return Admission(view, client_key)
+
+
+async def aget_admission(view, request):
+    limits = get_limits(view)
+    if limits is None:
+        return None
+    client_key = await sync_to_async(get_client_key)(request)
+    status = await limiter.aacquire(view, client_key, *limits, getattr(settings, 'SOFA_ADMISSION_QUEUE_TIMEOUT', 1))
+    if status is not None:
+        return get_rejected_response(view, status)
+    return Admission(view, client_key)
+
+
+def admission_view(view_func):
+    """
+    Limit the requests served at once by the view (see get_limits): a request waits up to
+    SOFA_ADMISSION_QUEUE_TIMEOUT seconds for a slot, then gets a 503 (the view is busy) or a 429 (the client
+    has too many requests running) with Retry-After, so replicating clients back off.
+    """
+    return tracking_view(get_admission, aget_admission)(view_func)
@@ -6,5 +6,9 @@ class SofaConfig(AppConfig):
     name = 'sofa'
 
     def ready(self):
-        from .loader import load
-        load()
\ No newline at end of file
+        from django.db.models.signals import post_migrate
+        from .loader import load, create_document_types
+        from .metrics import install
+        load()
+        install()
+        post_migrate.connect(create_document_types, sender=self)
\ No newline at end of file
@@ -0,0 +1,19 @@
+from django.urls import path
+from .views import database, index, document, bulk_docs, snapshot, metrics
+from .async_views import replication_log, changes, all_docs, bulk_get, revs_diff
+
+# same routes as sofa.urls, serving the replication endpoints with native async views
+urlpatterns = [
+    path('', index),
+    path('_metrics', metrics),
+    path('<db_name>/', database),
+    path('<db_name>/_local/<replication_id>', replication_log),
+    path('<db_name>/_changes', changes),
+    path('<db_name>/_all_docs', all_docs),
+    path('<db_name>/_bulk_get', bulk_get),
+    path('<db_name>/_revs_diff', revs_diff),
+    path('<db_name>/_snapshot', snapshot),
+    path('<db_name>/_bulk_docs', bulk_docs),
+    # after the _ routes, which it would match as well
+    path('<db_name>/<document_id>', document),
+]
@@ -0,0 +1,208 @@
+import asyncio
+import json
+from functools import wraps
+
+from asgiref.sync import sync_to_async
+from django.http import JsonResponse, HttpResponseNotAllowed, StreamingHttpResponse, HttpResponseBadRequest
+from django.utils.cache import patch_cache_control
+
+from .base import (
+    get_documents_chunk_content, iter_documents_chunks, get_documents_executor, iter_submitted_documents_chunks, merge_documents_chunk,
+)
+from .metrics import instrument_view, add_rows
+from .admission import admission_view
+from .compression import compress_view
+from .profiling import profile_view
+from .routers import replica_view, get_replica_databases, remember_client_seq
+from .sequence import get_update_seq
+from .views import (
+    database_view, save_replication_log, get_replication_history, get_replication_log_response, get_replication_log_saved_response,
+    get_changes_queryset, get_changes_document_types, get_change_revisions_queryset, get_change_row, add_changes_docs, get_empty_changes_last_seq, get_all_docs_rows,
+    get_all_docs_params, iter_all_docs, get_requested_documents, get_document_result, check_bulk_get_request, get_revs_diff,
+)
+
+# Async variants of the replication endpoints, to be served under ASGI (see sofa.async_urls).
+# Requires Django >= 4.2 (async ORM and async iterators in StreamingHttpResponse).
+
+
+def async_view(methods, csrf_exempt=False):
+    # require_http_methods, csrf_exempt and cache_control don't support coroutines before django 5.0
+    def decorator(view_func):
+        @wraps(view_func)
+        async def wrapped_view(request, *args, **kwargs):
+            if request.method not in methods:
+                return HttpResponseNotAllowed(methods)
+            response = await view_func(request, *args, **kwargs)
+            patch_cache_control(response, must_revalidate=True)
+            return response
+        wrapped_view.csrf_exempt = csrf_exempt
+        return wrapped_view
+    return decorator
+
+
+async def aiterate(iterable):
+    # drive a sync generator (queries and serializers) from the event loop, one item at a time
+    iterator = iter(iterable)
+    end = object()
+    while True:
+        item = await sync_to_async(next)(iterator, end)
+        if item is end:
+            return
+        yield item
+
+
+@instrument_view
+@database_view
+@async_view(['GET', 'PUT'], csrf_exempt=True)
+async def replication_log(request, db_name, replication_id):
+    if request.method == 'PUT':
+        body = json.loads(request.body.decode('utf-8'))
+        rep_log, last_history = await sync_to_async(save_replication_log)(replication_id, body)
+        return get_replication_log_saved_response(rep_log, last_history)
+
+    history = [h async for h in get_replication_history(replication_id)]
+    return get_replication_log_response(request, history)
+
+
+@instrument_view
+@database_view
+@profile_view
+@admission_view
+@compress_view
+@replica_view
+@async_view(['GET'])
+async def changes(request, db_name):
+    since = int(request.GET.get('since', '0'))
+    limit = int(request.GET.get('limit', '1000'))
+    feed = request.GET.get('feed', 'normal')
+    include_docs = request.GET.get('include_docs') == 'true'
+
+    if feed != 'normal':
+        return HttpResponseBadRequest('{"error": "sync style not implemented"}', content_type='application/json')
+    document_types = get_changes_document_types(request)
+    if document_types == []:
+        return HttpResponseBadRequest('{"error": "bad_request", "reason": "the sofa/by_type filter requires a type"}', content_type='application/json')
+
+    results = []
+    last_change = 0
+    changes_page = []
+    # the document types are looked up (and cached) while building the queryset
+    changes_queryset = await sync_to_async(get_changes_queryset)(db_name, since, limit, document_types)
+    async for change in changes_queryset:
+        revisions = [r async for r in get_change_revisions_queryset(since, change)]
+        results.append(get_change_row(change, revisions[::-1]))
+        changes_page.append(change)
+        last_change = change.id
+    if include_docs:
+        await sync_to_async(add_changes_docs)(request, results, changes_page)
+
+    add_rows(len(results))
+    if not last_change:
+        last_change = await sync_to_async(get_empty_changes_last_seq)(db_name, since)
+    if get_replica_databases():
+        await sync_to_async(remember_client_seq)(request, last_change)
+
+    return JsonResponse({
+        "results": results,
+        "last_seq": str(last_change)
+    })
+
+
+@instrument_view
+@database_view
+@profile_view
+@admission_view
+@compress_view
+@replica_view
+@async_view(['GET', 'POST'], csrf_exempt=True)
+async def all_docs(request, db_name):
+    include_docs = request.GET.get('include_docs') == 'true'
+
+    if request.method == 'GET':
+        return StreamingHttpResponse(
+            streaming_content=aiterate(iter_all_docs(request, db_name, include_docs, **get_all_docs_params(request))),
+            content_type='application/json',
+        )
+
+    body = json.loads(request.body.decode('utf-8'))
+    keys = body.get('keys', [])
+
+    # document ids are resolved through the document types, sync code
+    rows = await sync_to_async(get_all_docs_rows)(db_name, keys)
+    add_rows(len(rows))
+
+    return JsonResponse({
+        "rows": rows,
+        "total_rows": len(rows),
+        "update_seq": await sync_to_async(get_update_seq(db_name).get_last_seq)()
+    })
+
+
+async def aiter_documents_chunks_content(request, documents, return_revisions):
+    executor = get_documents_executor()
+    if executor is None:
+        # serializers are sync code: every chunk is loaded and rendered in a worker thread
+        for chunk in iter_documents_chunks(documents):
+            yield await sync_to_async(get_documents_chunk_content)(request, chunk, return_revisions)
+        return
+
+    for chunk, tasks in iter_submitted_documents_chunks(executor, request, documents, return_revisions):
+        yield merge_documents_chunk(chunk, [(positions, await asyncio.wrap_future(future)) for positions, future in tasks])
+
+
+async def aiter_documents(request, db_name, requested_docs, return_revisions):
+    documents = await sync_to_async(get_requested_documents)(db_name, requested_docs)
+
+    yield '{"results": ['
+
+    first = True
+
+    async for chunk_contents in aiter_documents_chunks_content(request, documents, return_revisions):
+        for key, content in chunk_contents:
+
+            if not first:
+                yield ","
+
+            first = False
+
+            add_rows()
+            yield get_document_result(key, content)
+
+        yield ''
+
+    yield ']}'
+
+
+@instrument_view
+@database_view
+@profile_view
+@admission_view
+@compress_view
+@replica_view
+@async_view(['POST'], csrf_exempt=True)
+async def bulk_get(request, db_name):
+    error_response = check_bulk_get_request(request)
+    if error_response:
+        return error_response
+
+    return_revisions = request.GET.get('revs') == 'true'
+    body = json.loads(request.body.decode('utf-8'))
+
+    return StreamingHttpResponse(
+        streaming_content=aiter_documents(request, db_name, body, return_revisions),
+        content_type='application/json',
+    )
+
+
+@instrument_view
+@database_view
+@profile_view
+@admission_view
+@replica_view
+@async_view(['POST'], csrf_exempt=True)
+async def revs_diff(request, db_name):
+    changed_docs = json.loads(request.body.decode('utf-8'))
+
+    missing = await sync_to_async(get_revs_diff)(db_name, changed_docs)
+    add_rows(len(missing))
+    return JsonResponse(missing)
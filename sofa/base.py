@@ -1,8 +1,21 @@
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
+from itertools import islice
+from threading import Lock
 from secrets import token_hex
+from time import perf_counter
 
-from django.core.exceptions import ObjectDoesNotExist
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured, ObjectDoesNotExist
+from django.db import close_old_connections
+from django.db.models import F, IntegerField
+from django.db.models.functions import Abs, Mod
 from rest_framework.serializers import ModelSerializer
 from rest_framework.renderers import JSONRenderer
+from .loader import DEFAULT_DATABASE
+from .metrics import serialization_duration, documents_serialized
+from .profiling import phase
 from .models import Change
 import logging
 
@@ -18,6 +31,91 @@ class DocumentBase(ModelSerializer):
             return cls.Meta.single_document
         return False
 
+    @classmethod
+    def get_database(cls):
+        # the logical database serving the document (Meta.database), with its own changes feed and update_seq
+        return getattr(getattr(cls, 'Meta', None), 'database', DEFAULT_DATABASE)
+
+    @classmethod
+    def is_snapshot_document(cls):
+        # part of the snapshots of its database (see sofa.snapshots), served to every client
+        return getattr(cls.Meta, 'snapshot', False)
+
+    @classmethod
+    def check_snapshot(cls):
+        # a snapshot is built once for every client, without a request: a class filtering its instances by request
+        # would give every client the documents of all of them
+        if cls.is_snapshot_document() and getattr(cls.get_queryset, '__func__', None) is not DocumentBase.get_queryset.__func__:
+            raise ImproperlyConfigured(f"{cls.__name__}: Meta.snapshot documents are served to every client, they can't filter get_queryset by request")
+
+    @classmethod
+    def get_shards(cls):
+        # a single document can be split in Meta.shards documents ("<document_id>:<shard>"), so a change
+        # of an instance only changes the revision of its shard
+        if cls.is_single_document():
+            return getattr(cls.Meta, 'shards', None)
+        return None
+
+    @classmethod
+    def get_replica_model_field(cls):
+        field = cls.get_replica_field()
+        opts = cls.Meta.model._meta
+        return opts.pk if field == 'pk' else opts.get_field(field)
+
+    @classmethod
+    def check_shards(cls):
+        # the shard of an instance is computed by the database (see filter_shard), only integer keys can be sharded
+        if cls.get_shards() and not isinstance(cls.get_replica_model_field(), IntegerField):
+            raise ImproperlyConfigured(f"{cls.__name__}: Meta.shards needs an integer replica_field ({cls.get_replica_field()})")
+
+    @classmethod
+    def get_shard(cls, instance):
+        return abs(cls.get_instance_id_value(instance)) % cls.get_shards()
+
+    @classmethod
+    def filter_shard(cls, queryset, shard):
+        field = cls.get_replica_field()
+        return queryset.annotate(sofa_shard=Mod(Abs(F(field)), cls.get_shards())).filter(sofa_shard=shard)
+
+    @classmethod
+    def get_single_document_ids(cls):
+        if cls.get_shards():
+            return [f"{cls.Meta.document_id}:{shard}" for shard in range(cls.get_shards())]
+        return [cls.Meta.document_id]
+
+    @classmethod
+    def get_single_document_instances(cls, doc_id, request):
+        queryset = cls.prefetch_queryset(cls.get_queryset(request), request)
+        if cls.get_shards():
+            shard = cls.get_entity_id(doc_id)
+            if not shard.isdigit() or int(shard) >= cls.get_shards():
+                raise cls.Meta.model.DoesNotExist
+            queryset = cls.filter_shard(queryset, int(shard))
+        return queryset
+
+    @classmethod
+    def get_revs_limit(cls):
+        # the revisions returned in _revisions, like the revs_limit of a CouchDB database. None for all of them
+        if hasattr(getattr(cls, 'Meta', None), 'revs_limit'):
+            return cls.Meta.revs_limit
+        revs_limit = getattr(settings, 'SOFA_REVS_LIMIT', 1000)
+        if isinstance(revs_limit, dict):
+            # a limit by database name, like the revs_limit of every CouchDB database
+            return revs_limit.get(cls.get_database(), 1000)
+        return revs_limit
+
+    @classmethod
+    def get_revisions(cls, change):
+        """
+        The latest revisions of the document of change, at most get_revs_limit, and the count of all of them.
+        The limit is applied by the database, the count is only queried for the documents having more revisions.
+        """
+        limit = cls.get_revs_limit()
+        revisions = list(Change.objects.get_revisions_for_change(change, limit))
+        if limit is not None and len(revisions) == limit:
+            return revisions, Change.objects.get_revisions_for_change(change).count()
+        return revisions, len(revisions)
+
     @classmethod
     def get_replica_field(cls):
         if hasattr(cls.Meta, 'replica_field'):
@@ -31,12 +129,14 @@ class DocumentBase(ModelSerializer):
     @classmethod
     def get_document_id(cls, instance):
         if cls.is_single_document():
+            if cls.get_shards():
+                return f"{cls.Meta.document_id}:{cls.get_shard(instance)}"
             return cls.Meta.document_id
         else:
             return "{}:{}".format(cls.Meta.document_id, cls.get_instance_id_value(instance))
 
     @classmethod
-    def wrap_content_with_metadata(cls, document_id, doc, revision, revisions):
+    def wrap_content_with_metadata(cls, document_id, doc, revision, revisions, revisions_start=None):
         if isinstance(doc, list):
             doc = {
                 "value": doc
@@ -47,31 +147,62 @@ class DocumentBase(ModelSerializer):
         if revisions:
             doc["_revisions"] = {
                 "ids": revisions,
-                "start": len(revisions)
+                # revisions can be limited (see get_revs_limit): the start is still the count of all of them
+                "start": revisions_start or len(revisions)
             }
 
         return doc
 
+    @classmethod
+    def get_entity_id(cls, doc_id):
+        return ":".join(doc_id.split(':')[1:])
+
     @classmethod
     def get_document_instance(cls, doc_id, request):
         if cls.is_single_document():
-            return cls.get_queryset(request)
+            return cls.get_single_document_instances(doc_id, request)
         else:
-            entity_id = ":".join(doc_id.split(':')[1:])
-            return cls.get_queryset(request).get(**{cls.get_replica_field(): entity_id})
+            return cls.get_queryset(request).get(**{cls.get_replica_field(): cls.get_entity_id(doc_id)})
+
+    @classmethod
+    def get_document_instances(cls, doc_ids, request):
+        # load many documents of this class with a single query, returns a map doc_id -> instance
+        if cls.is_single_document():
+            instances = {}
+            for doc_id in doc_ids:
+                try:
+                    instances[doc_id] = cls.get_single_document_instances(doc_id, request)
+                except ObjectDoesNotExist:
+                    pass
+            return instances
+
+        entity_ids = {cls.get_entity_id(doc_id) for doc_id in doc_ids}
+        queryset = cls.prefetch_queryset(cls.get_queryset(request), request)
+        instances = queryset.filter(**{f"{cls.get_replica_field()}__in": entity_ids})
+        return {cls.get_document_id(instance): instance for instance in instances}
+
+    @classmethod
+    def get_instance_content(cls, doc_id, instance, revision, revisions, request, revisions_start=None):
+        if instance is None:
+            return cls.wrap_content_with_metadata(doc_id, {"_deleted": True}, revision, revisions, revisions_start)
+        start = perf_counter()
+        doc_serializer = cls(instance, many=cls.is_single_document(), context={'request': request})
+        content = doc_serializer.data
+        serialization_duration.observe(perf_counter() - start, cls.Meta.document_id)
+        documents_serialized.inc(1, cls.Meta.document_id)
+        return cls.wrap_content_with_metadata(doc_id, content, revision, revisions, revisions_start)
 
     @classmethod
     def get_document_content(cls, doc_id, revision, revisions, request, force_delete=False):
 
         if force_delete:
-            return cls.wrap_content_with_metadata(doc_id, {"_deleted": True}, revision, revisions)
+            return cls.get_instance_content(doc_id, None, revision, revisions, request)
 
         try:
             instance = cls.get_document_instance(doc_id, request)
         except ObjectDoesNotExist:
-            return cls.wrap_content_with_metadata(doc_id, {"_deleted": True}, revision, revisions)
-        doc_serializer = cls(instance, many=cls.is_single_document(), context={'request': request})
-        return cls.wrap_content_with_metadata(doc_id, doc_serializer.data, revision, revisions)
+            instance = None
+        return cls.get_instance_content(doc_id, instance, revision, revisions, request)
 
     @classmethod
     def get_document_content_as_json(cls, doc_id, revision, revisions, request, force_delete=False):
@@ -108,10 +239,11 @@ class DocumentBase(ModelSerializer):
     @classmethod
     def add_revision(cls, instance=None):
         if cls.is_single_document():
-            Change.objects.create(
-                document_id=cls.Meta.document_id,
-                revision=token_hex(16)
-            )
+            for document_id in cls.get_single_document_ids():
+                Change.objects.create(
+                    document_id=document_id,
+                    revision=token_hex(16)
+                )
         else:
             if instance:
                 Change.objects.create(
@@ -132,6 +264,17 @@ class DocumentBase(ModelSerializer):
         Model = cls.Meta.model
         return Model.objects.all()
 
+    @classmethod
+    def prefetch_queryset(cls, queryset, request=None):
+        # the relations serialized with the documents (Meta.select_related, Meta.prefetch_related) are loaded once for
+        # all the instances of a query, instead of once per document
+        meta = getattr(cls, 'Meta', None)
+        if getattr(meta, 'select_related', None):
+            queryset = queryset.select_related(*meta.select_related)
+        if getattr(meta, 'prefetch_related', None):
+            queryset = queryset.prefetch_related(*meta.prefetch_related)
+        return queryset
+
     @classmethod
     def apply_delete(cls, doc_id, rev_id, request):
         try:
@@ -217,3 +360,134 @@ class DocumentBase(ModelSerializer):
     @classmethod
     def can_add(cls, request):
         return True
+
+
+def get_documents_chunk_content(request, documents, return_revisions):
+    """
+    Serialize a chunk of (doc_id, document_info) pairs, loading the instances with one query per document class.
+    Returns a list of (doc_id, content) in the same order of documents.
+    """
+    from .loader import get_class_by_document_id
+
+    doc_ids_by_class = defaultdict(list)
+    for doc_id, document_info in documents:
+        if not document_info['deleted']:
+            doc_ids_by_class[get_class_by_document_id(doc_id)].append(doc_id)
+
+    instances = {}
+    with phase('documents.load'):
+        for document_class, doc_ids in doc_ids_by_class.items():
+            if document_class:
+                instances.update(document_class.get_document_instances(doc_ids, request))
+
+    contents = []
+    for doc_id, document_info in documents:
+        # documents without a related class in django are returned as deleted
+        document_class = get_class_by_document_id(doc_id) or DocumentBase
+        with phase('documents.revisions'):
+            revisions, revisions_start = document_class.get_revisions(document_info['change']) if return_revisions else ([], None)
+        with phase('documents.serialize'):
+            instance = instances.get(doc_id)
+            contents.append((doc_id, document_class.get_instance_content(doc_id, instance, document_info['rev'], revisions, request, revisions_start)))
+    return contents
+
+
+def iter_documents_chunks(documents, chunk_size=None):
+    chunk_size = chunk_size or getattr(settings, 'SOFA_DOCUMENTS_CHUNK_SIZE', 100)
+    documents = iter(documents)
+    chunk = list(islice(documents, chunk_size))
+    while chunk:
+        yield chunk
+        chunk = list(islice(documents, chunk_size))
+
+
+_documents_executor = None
+_documents_executor_lock = Lock()
+
+
+def get_documents_executor():
+    # the thread pool of SOFA_BULK_GET_WORKERS threads shared by the requests, None when disabled
+    global _documents_executor
+    workers = getattr(settings, 'SOFA_BULK_GET_WORKERS', 0)
+    if not workers:
+        return None
+    with _documents_executor_lock:
+        if _documents_executor is None or _documents_executor[0] != workers:
+            if _documents_executor is not None:
+                _documents_executor[1].shutdown(wait=False)
+            _documents_executor = (workers, ThreadPoolExecutor(workers, thread_name_prefix='sofa-documents'))
+        return _documents_executor[1]
+
+
+def get_documents_chunk_content_in_worker(request, documents, return_revisions):
+    # every worker has its own connection, closed when too old like at the end of a request (CONN_MAX_AGE)
+    close_old_connections()
+    try:
+        return get_documents_chunk_content(request, documents, return_revisions)
+    finally:
+        close_old_connections()
+
+
+def submit_documents_chunk(executor, request, chunk, return_revisions):
+    """
+    Load and serialize a chunk in the thread pool, a task for every document class of the chunk.
+    Returns a list of (positions in the chunk, future). The tasks run in a copy of the current context,
+    so they read the database chosen for the request and report to its profile.
+    """
+    from .loader import get_class_by_document_id
+
+    positions_by_class = defaultdict(list)
+    for position, (doc_id, _) in enumerate(chunk):
+        positions_by_class[get_class_by_document_id(doc_id)].append(position)
+
+    return [
+        (positions, executor.submit(copy_context().run, get_documents_chunk_content_in_worker, request, [chunk[p] for p in positions], return_revisions))
+        for positions in positions_by_class.values()
+    ]
+
+
+def merge_documents_chunk(chunk, results):
+    # the contents of the tasks of a chunk, back in the order of the chunk
+    contents = [None] * len(chunk)
+    for positions, task_contents in results:
+        for position, content in zip(positions, task_contents):
+            contents[position] = content
+    return contents
+
+
+def iter_submitted_documents_chunks(executor, request, documents, return_revisions):
+    # (chunk, tasks) in order, the next chunks are submitted while a chunk is returned: one for every worker
+    ahead = getattr(settings, 'SOFA_BULK_GET_WORKERS', 0)
+    pending = deque()
+    try:
+        for chunk in iter_documents_chunks(documents):
+            pending.append((chunk, submit_documents_chunk(executor, request, chunk, return_revisions)))
+            if len(pending) > ahead:
+                yield pending.popleft()
+        while pending:
+            yield pending.popleft()
+    finally:
+        # the response was closed before the end
+        for _, tasks in pending:
+            for _, future in tasks:
+                future.cancel()
+
+
+def iter_documents_chunks_content(request, documents, return_revisions):
+    """
+    The contents of every chunk of documents, in order. With SOFA_BULK_GET_WORKERS the next chunks are loaded
+    and serialized by a thread pool while the current one is sent.
+    """
+    executor = get_documents_executor()
+    if executor is None:
+        for chunk in iter_documents_chunks(documents):
+            yield get_documents_chunk_content(request, chunk, return_revisions)
+        return
+
+    for chunk, tasks in iter_submitted_documents_chunks(executor, request, documents, return_revisions):
+        yield merge_documents_chunk(chunk, [(positions, future.result()) for positions, future in tasks])
+
+
+def iter_documents_content(request, documents, return_revisions):
+    for chunk in iter_documents_chunks(documents):
+        yield from get_documents_chunk_content(request, chunk, return_revisions)
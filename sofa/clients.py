@@ -0,0 +1,14 @@
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+
+def get_client_key(request):
+    # the user for authenticated requests, the address otherwise. SOFA_CLIENT_KEY_FUNCTION can point to another function
+    function = getattr(settings, 'SOFA_CLIENT_KEY_FUNCTION', None)
+    if function:
+        return import_string(function)(request)
+
+    user = getattr(request, 'user', None)
+    if user is not None and user.is_authenticated:
+        return f"user:{user.pk}"
+    return f"address:{request.META.get('REMOTE_ADDR', '')}"
@@ -0,0 +1,174 @@
+import asyncio
+import re
+import zlib
+from functools import partial, wraps
+
+from django.conf import settings
+from django.utils.cache import patch_vary_headers
+
+from .streaming import wrap_streaming_content
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# bodies smaller than this aren't worth the compression headers
+MIN_LENGTH = 200
+
+
+class GzipCompressor:
+    default_level = 6
+
+    def __init__(self, level):
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, data):
+        return self.compressor.compress(data)
+
+    def flush(self):
+        return self.compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self.compressor.flush(zlib.Z_FINISH)
+
+
+class BrotliCompressor:
+    # brotli default quality (11) is meant for static files
+    default_level = 4
+
+    def __init__(self, level):
+        self.compressor = brotli.Compressor(quality=level)
+
+    def compress(self, data):
+        return self.compressor.process(data)
+
+    def flush(self):
+        return self.compressor.flush()
+
+    def finish(self):
+        return self.compressor.finish()
+
+
+class ZstdCompressor:
+    default_level = 3
+
+    def __init__(self, level):
+        self.compressor = zstandard.ZstdCompressor(level=level).compressobj()
+
+    def compress(self, data):
+        return self.compressor.compress(data)
+
+    def flush(self):
+        return self.compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+
+    def finish(self):
+        return self.compressor.flush()
+
+
+def get_compressors():
+    compressors = {'gzip': GzipCompressor}
+    if brotli is not None:
+        compressors['br'] = BrotliCompressor
+    if zstandard is not None:
+        compressors['zstd'] = ZstdCompressor
+    return compressors
+
+
+def get_accepted_encodings(request):
+    accepted = {}
+    for item in request.META.get('HTTP_ACCEPT_ENCODING', '').split(','):
+        encoding, _, params = item.strip().partition(';')
+        match = re.search(r'q=([0-9.]+)', params)
+        try:
+            accepted[encoding.strip().lower()] = float(match.group(1)) if match else 1.0
+        except ValueError:
+            continue
+    return accepted
+
+
+def negotiate_encoding(request):
+    # the first of SOFA_COMPRESSION_ENCODINGS available and accepted by the client, None for identity
+    accepted = get_accepted_encodings(request)
+    compressors = get_compressors()
+    for encoding in getattr(settings, 'SOFA_COMPRESSION_ENCODINGS', ['zstd', 'br', 'gzip']):
+        if encoding in compressors and accepted.get(encoding, accepted.get('*', 0)) > 0:
+            return encoding
+    return None
+
+
+def get_compressor(encoding):
+    # SOFA_COMPRESSION_LEVEL: a level for every encoding, or a dict by encoding
+    compressor_class = get_compressors()[encoding]
+    level = getattr(settings, 'SOFA_COMPRESSION_LEVEL', None)
+    if isinstance(level, dict):
+        level = level.get(encoding)
+    return compressor_class(compressor_class.default_level if level is None else level)
+
+
+def compress_chunk(compressor, chunk):
+    # the views yield an empty chunk after a batch of documents: the documents compressed so far are flushed,
+    # so the client can parse them while the next batch is loaded. Flushing every document costs ~50% in size
+    if chunk:
+        return compressor.compress(chunk)
+    return compressor.flush()
+
+
+def iter_compressed_content(compressor, streaming_content):
+    for chunk in streaming_content:
+        compressed = compress_chunk(compressor, chunk)
+        if compressed:
+            yield compressed
+    yield compressor.finish()
+
+
+async def aiter_compressed_content(compressor, streaming_content):
+    async for chunk in streaming_content:
+        compressed = compress_chunk(compressor, chunk)
+        if compressed:
+            yield compressed
+    yield compressor.finish()
+
+
+def compress_response(request, response):
+    if response.has_header('Content-Encoding') or not 200 <= response.status_code < 300:
+        return response
+    if not response.streaming and len(response.content) < MIN_LENGTH:
+        return response
+
+    patch_vary_headers(response, ('Accept-Encoding',))
+    encoding = negotiate_encoding(request)
+    if encoding is None:
+        return response
+
+    compressor = get_compressor(encoding)
+    if response.streaming:
+        wrap_streaming_content(response, partial(iter_compressed_content, compressor), partial(aiter_compressed_content, compressor))
+        del response['Content-Length']
+    else:
+        response.content = compressor.compress(response.content) + compressor.finish()
+    response['Content-Encoding'] = encoding
+    return response
+
+
+def compress_view(view_func):
+    """
+    Compress the response with the encoding negotiated from Accept-Encoding (gzip, br with brotli installed,
+    zstd with zstandard installed). Streaming content is compressed chunk by chunk, GZipMiddleware skips it.
+    """
+    if asyncio.iscoroutinefunction(view_func):
+        @wraps(view_func)
+        async def async_wrapped_view(request, *args, **kwargs):
+            return compress_response(request, await view_func(request, *args, **kwargs))
+        return async_wrapped_view
+
+    @wraps(view_func)
+    def wrapped_view(request, *args, **kwargs):
+        return compress_response(request, view_func(request, *args, **kwargs))
+    return wrapped_view
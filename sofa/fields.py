@@ -0,0 +1,43 @@
+from django.db import models
+
+
+def is_revision(value):
+    try:
+        return len(bytes.fromhex(value)) == RevisionField.size
+    except (TypeError, ValueError):
+        return False
+
+
+class RevisionField(models.BinaryField):
+    """
+    A revision hash (32 hex chars, like the md5 revisions of pouchdb) stored as 16 raw bytes.
+    Python code reads and writes the hex string.
+    """
+    size = 16
+
+    def db_type(self, connection):
+        # blob columns can't be part of an index on mysql and oracle
+        if connection.vendor == 'mysql':
+            return f'binary({self.size})'
+        if connection.vendor == 'oracle':
+            return f'RAW({self.size})'
+        return super().db_type(connection)
+
+    def from_db_value(self, value, expression, connection):
+        if value is None:
+            return value
+        return bytes(value).hex()
+
+    def to_python(self, value):
+        if isinstance(value, (bytes, bytearray, memoryview)):
+            return bytes(value).hex()
+        return value
+
+    def get_prep_value(self, value):
+        value = super().get_prep_value(value)
+        if isinstance(value, str):
+            return bytes.fromhex(value)
+        return value
+
+    def value_to_string(self, obj):
+        return self.value_from_object(obj)
@@ -1,25 +1,43 @@
 from importlib import import_module
 
-from django.db import transaction
+from django.db import transaction, router, DEFAULT_DB_ALIAS
 from django.db.models.signals import post_save, post_delete
+from django.utils.module_loading import import_string, module_has_submodule
 
 
+# the database of the document classes without Meta.database, served under db/ like before
+DEFAULT_DATABASE = 'db'
+
 _DOCUMENT_ID_TO_CLASS = {}
+_DATABASE_TO_DOCUMENT_IDS = {}
 
 
 def get_apps_packages():
     from django.apps import apps
-    return [config.name for config in apps.get_app_configs()]
+    return [config.module for config in apps.get_app_configs()]
 
 
 def load_document_classes(packages):
+    # like admin.autodiscover: only the apps having the module are imported, errors raised by the module aren't hidden
     from django.conf import settings
     for package in packages:
-        try:
-            # TODO: add default module name
-            import_module('{}.{}'.format(package, settings.SOFA_MODULE_NAME))
-        except ImportError:
-            pass
+        # TODO: add default module name
+        if module_has_submodule(package, settings.SOFA_MODULE_NAME):
+            import_module('{}.{}'.format(package.__name__, settings.SOFA_MODULE_NAME))
+
+
+def get_document_classes():
+    """
+    The classes listed by SOFA_DOCUMENTS (dotted paths), or the subclasses of DocumentBase found in the
+    SOFA_MODULE_NAME module of every installed app.
+    """
+    from django.conf import settings
+    paths = getattr(settings, 'SOFA_DOCUMENTS', None)
+    if paths is not None:
+        return [import_string(path) for path in paths]
+    load_document_classes(get_apps_packages())
+    from .base import DocumentBase
+    return DocumentBase.__subclasses__()
 
 
 def register_to_model_signals(cls):
@@ -29,8 +47,48 @@ def register_to_model_signals(cls):
     post_delete.connect(cls.on_delete, sender=Model, dispatch_uid="delete_{}".format(Model._meta.label_lower))
 
 
+def get_document_types():
+    return list(_DOCUMENT_ID_TO_CLASS)
+
+
 def get_class_by_document_id(document_id):
-    return _DOCUMENT_ID_TO_CLASS.get(document_id.split(':')[0])
+    return _DOCUMENT_ID_TO_CLASS.get(document_id.partition(':')[0])
+
+
+def get_databases():
+    return list(_DATABASE_TO_DOCUMENT_IDS)
+
+
+def get_database_document_types(database):
+    return _DATABASE_TO_DOCUMENT_IDS.get(database, [])
+
+
+def get_database_by_document_id(document_id):
+    # the changes of an unknown document class go to the default database, they can't be read anyway
+    cls = get_class_by_document_id(document_id)
+    return cls.get_database() if cls is not None else DEFAULT_DATABASE
+
+
+def filter_database_document_ids(database, ids):
+    return [document_id for document_id in ids if get_database_by_document_id(document_id) == database]
+
+
+def split_document_id(document_id):
+    # "user:42" -> ("user", "42"), single documents have an empty key: "groups" -> ("groups", "")
+    document_type, _, key = document_id.partition(':')
+    return document_type, key
+
+
+def join_document_id(document_type, key):
+    return f"{document_type}:{key}" if key else document_type
+
+
+def get_document_id_prefix(document_type):
+    # the ids of the documents of the type are this prefix followed by their key
+    cls = _DOCUMENT_ID_TO_CLASS.get(document_type)
+    if cls is not None and cls.is_single_document() and not cls.get_shards():
+        return document_type
+    return f"{document_type}:"
 
 
 def patch_model(model_class):
@@ -45,22 +103,45 @@ def patch_model(model_class):
 
 
 def load():
-    load_document_classes(get_apps_packages())
     _DOCUMENT_ID_TO_CLASS.clear()
-    from .base import DocumentBase
-    for cls in DocumentBase.__subclasses__():
+    _DATABASE_TO_DOCUMENT_IDS.clear()
+    _DATABASE_TO_DOCUMENT_IDS[DEFAULT_DATABASE] = []
+    for cls in get_document_classes():
         document_id = cls.Meta.document_id
         if document_id in _DOCUMENT_ID_TO_CLASS:
             raise Exception("Duplicated document_id found in class: {} and {}".format(cls, _DOCUMENT_ID_TO_CLASS[document_id]))
         _DOCUMENT_ID_TO_CLASS[document_id] = cls
+        cls.check_shards()
+        cls.check_snapshot()
+        _DATABASE_TO_DOCUMENT_IDS.setdefault(cls.get_database(), []).append(document_id)
         register_to_model_signals(cls)
         patch_model(cls.Meta.model)
 
 
-def init_revisions():
+def init_revisions(document_types=None):
+    # all the documents, or only the documents of the given types
     from .models import Change
     with transaction.atomic():
-        Change.objects.all().delete()
-        for document_class in _DOCUMENT_ID_TO_CLASS.values():
+        if document_types is None:
+            Change.objects.all().delete()
+            document_classes = _DOCUMENT_ID_TO_CLASS.values()
+        else:
+            Change.objects.for_document_types(document_types).delete()
+            document_classes = [_DOCUMENT_ID_TO_CLASS[document_type] for document_type in document_types]
+        for document_class in document_classes:
             document_class.add_revision()
 
+
+def create_document_types(using=DEFAULT_DB_ALIAS, apps=None, **kwargs):
+    # like content types, the types of the loaded documents are created after migrate (and flush)
+    from .models import DocumentType
+    DocumentType.objects.clear_cache()
+    if apps is not None:
+        try:
+            DocumentType = apps.get_model('sofa', 'DocumentType')
+        except LookupError:
+            return
+    if not router.allow_migrate_model(using, DocumentType):
+        return
+    existing = set(DocumentType.objects.using(using).values_list('name', flat=True))
+    DocumentType.objects.using(using).bulk_create([DocumentType(name=name) for name in sorted(set(_DOCUMENT_ID_TO_CLASS) - existing)])
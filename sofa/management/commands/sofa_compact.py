@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.translation import gettext_lazy as _
+from sofa.models import Change, DocumentType
+
+
+class Command(BaseCommand):
+    help = _('Delete the changes superseded by newer changes of the same document')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--type', action='append', dest='types', help=_('Only compact the changes of this type (Meta.document_id), can be repeated'))
+        parser.add_argument('--keep', type=int, default=1, help=_('Revisions kept for every document (default: 1)'))
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        if options['keep'] < 1:
+            raise CommandError('--keep must be at least 1')
+
+        document_types = DocumentType.objects.order_by('name')
+        if options['types']:
+            document_types = document_types.filter(name__in=options['types'])
+            unknown = set(options['types']) - {document_type.name for document_type in document_types}
+            if unknown:
+                raise CommandError(f"Unknown document types: {', '.join(sorted(unknown))}")
+
+        for document_type in document_types:
+            # every batch only reads the slice of the log of the document type, after the last deleted change
+            superseded = Change.objects.get_superseded_changes(options['keep']).filter(document_type=document_type).order_by('pk')
+            deleted = last_id = 0
+            while True:
+                ids = list(superseded.filter(pk__gt=last_id).values_list('pk', flat=True)[:options['batch_size']])
+                if not ids:
+                    break
+                deleted += Change.objects.filter(pk__in=ids).delete()[0]
+                last_id = ids[-1]
+            self.stdout.write(f"{document_type.name}: {deleted} changes deleted")
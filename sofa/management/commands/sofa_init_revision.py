@@ -1,10 +1,17 @@
-from django.core.management.base import BaseCommand
-from django.utils.translation import ugettext_lazy as _
-from sofa.loader import init_revisions
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.translation import gettext_lazy as _
+from sofa.loader import init_revisions, get_document_types
 
 
 class Command(BaseCommand):
     help = _('Add initial revision for all sofa documents')
 
+    def add_arguments(self, parser):
+        parser.add_argument('--type', action='append', dest='types', help=_('Only reseed the documents of this type (Meta.document_id), can be repeated'))
+
     def handle(self, *args, **options):
-        init_revisions()
+        types = options['types']
+        unknown = set(types or []) - set(get_document_types())
+        if unknown:
+            raise CommandError(f"Unknown document types: {', '.join(sorted(unknown))}")
+        init_revisions(types)
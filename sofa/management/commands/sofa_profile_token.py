@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+from django.utils.translation import gettext_lazy as _
+from sofa.profiling import get_profile_token
+
+
+class Command(BaseCommand):
+    help = _('Print a signed value for the X-Sofa-Profile header, enabling the profiling of a request')
+
+    def handle(self, *args, **options):
+        self.stdout.write(get_profile_token())
@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.translation import gettext_lazy as _
+from sofa.loader import get_databases
+from sofa.snapshots import build_snapshot, get_snapshot_dir, get_snapshot_document_types
+
+
+class Command(BaseCommand):
+    help = _('Build the snapshot of the Meta.snapshot documents of the databases, served to new clients by _snapshot')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', action='append', dest='databases', help=_('Only build the snapshot of this database, can be repeated'))
+        parser.add_argument('--full', action='store_true', help=_('Serialize every document instead of updating the previous snapshot'))
+        parser.add_argument('--keep', type=int, default=2, help=_('Snapshots kept for every database, for the downloads running (default: 2)'))
+
+    def handle(self, *args, **options):
+        if not get_snapshot_dir():
+            raise CommandError('SOFA_SNAPSHOT_DIR is not set')
+        if options['keep'] < 1:
+            raise CommandError('--keep must be at least 1')
+
+        databases = options['databases'] or get_databases()
+        unknown = set(databases) - set(get_databases())
+        if unknown:
+            raise CommandError(f"Unknown databases: {', '.join(sorted(unknown))}")
+
+        for db_name in databases:
+            if not get_snapshot_document_types(db_name):
+                self.stdout.write(f"{db_name}: no document class with Meta.snapshot")
+                continue
+            seq, path, documents = build_snapshot(db_name, incremental=not options['full'], keep=options['keep'])
+            if documents is None:
+                self.stdout.write(f"{db_name}: up to date at seq {seq}")
+            else:
+                self.stdout.write(f"{db_name}: {documents} documents at seq {seq} in {path}")
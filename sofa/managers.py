@@ -1,12 +1,159 @@
-from django.db import models
-from django.db.models import Subquery, Max
+import operator
+from collections import defaultdict
+
+from django.db import models, transaction
+from django.db.models import OuterRef, Subquery, Max, Q
+
+from .loader import get_databases, get_database_document_types, get_document_id_prefix, split_document_id
+
+
+class DocumentTypeManager(models.Manager):
+    # the document types are a handful of rows read for every change, they are cached like content types
+    _cache = {}
+
+    def clear_cache(self):
+        self._cache.clear()
+
+    def _add_to_cache(self, using, document_type):
+        cache = self._cache.setdefault(using, {})
+        cache[document_type.name] = cache[document_type.id] = document_type
+
+    def _add_to_cache_on_commit(self, using, document_type):
+        # a row read or created by a transaction rolled back must not be reused, on_commit runs at once in autocommit
+        transaction.on_commit(lambda: self._add_to_cache(using, document_type), using=using)
+
+    def get_for_name(self, name):
+        # None when no change of this document type was ever written
+        cache = self._cache.get(self.db, {})
+        if name in cache:
+            return cache[name]
+        document_type = self.filter(name=name).first()
+        if document_type is not None:
+            self._add_to_cache_on_commit(self.db, document_type)
+        return document_type
+
+    def get_or_create_for_name(self, name):
+        document_type = self.get_for_name(name)
+        if document_type is None:
+            document_type, _ = self.get_or_create(name=name)
+            self._add_to_cache_on_commit(self.db, document_type)
+        return document_type
+
+    def get_for_id(self, id):
+        cache = self._cache.get(self.db, {})
+        if id in cache:
+            return cache[id]
+        document_type = self.get(pk=id)
+        self._add_to_cache_on_commit(self.db, document_type)
+        return document_type
 
 
 class ChangeManager(models.Manager):
+    def get_document_type_model(self):
+        return self.model._meta.get_field('document_type').related_model
+
+    def for_documents(self, ids):
+        # document ids are stored as (document type, key): the changes of an unknown document type don't exist
+        keys_by_type = defaultdict(set)
+        for document_id in ids:
+            document_type, key = split_document_id(document_id)
+            keys_by_type[document_type].add(key)
+
+        documents_filter = Q()
+        for name, keys in keys_by_type.items():
+            document_type = self.get_document_type_model().objects.get_for_name(name)
+            if document_type is not None:
+                documents_filter |= Q(document_type=document_type, document_key__in=keys)
+
+        return self.filter(documents_filter) if documents_filter else self.none()
+
+    def get_document_types(self, names):
+        # the document types having changes
+        document_types = [self.get_document_type_model().objects.get_for_name(name) for name in names]
+        return [document_type for document_type in document_types if document_type is not None]
+
+    def for_document_types(self, names):
+        return self.filter(document_type__in=self.get_document_types(names))
+
+    def for_database(self, database):
+        # the database of a change is the one of its document class (Meta.database): the log of a single database is
+        # the whole log, the others are read with the (document_type, id) index
+        if get_databases() == [database]:
+            return self.all()
+        return self.for_document_types(get_database_document_types(database))
+
+    def get_last_id(self, database):
+        # the update_seq of the database: its highest change, the highest of the changes of its document types
+        if get_databases() == [database]:
+            return self.aggregate(last_id=Max('pk'))['last_id'] or 0
+        last_ids = (self.filter(document_type=document_type).aggregate(last_id=Max('pk'))['last_id'] for document_type in self.get_document_types(get_database_document_types(database)))
+        return max((last_id for last_id in last_ids if last_id is not None), default=0)
+
     def get_latest_changes(self, ids):
         # only the latest revision is available, so load only the available revisions
         # a future django-reversion integration could be planned
-        return self.filter(pk__in=Subquery(self.model.objects.filter(document_id__in=ids).values('document_id').annotate(last_id=Max('pk')).values('last_id')))
+        return self.filter(pk__in=Subquery(self.for_documents(ids).values('document_type', 'document_key').annotate(last_id=Max('pk')).values('last_id')))
+
+    def iter_latest_changes(self, startkey=None, endkey=None, descending=False, inclusive_end=True, chunk_size=100, document_types=None):
+        # keyset pagination over the latest change of every document (of document_types), ordered by document id.
+        # Every chunk is bounded by the last key seen, so no query scans the whole log.
+        order, next_lookup, start_lookup = ('-document_key', 'lt', 'lte') if descending else ('document_key', 'gt', 'gte')
+        end_lookup = {'gt': 'lt', 'lt': 'gt'}[next_lookup] + ('e' if inclusive_end else '')
+        comes_before = operator.gt if descending else operator.lt
+
+        startkey = str(startkey) if startkey is not None else None
+        endkey = str(endkey) if endkey is not None else None
+
+        all_document_types = self.get_document_type_model().objects.all()
+        if document_types is not None:
+            all_document_types = all_document_types.filter(name__in=document_types)
+        # the documents of a type are its prefix followed by their key: ordering the types by prefix orders the ids
+        # ("user-profile:1" comes before "user:1", while "user" comes before "user-profile")
+        prefixes = sorted(((get_document_id_prefix(document_type.name), document_type) for document_type in all_document_types), key=operator.itemgetter(0), reverse=descending)
+        for prefix, document_type in prefixes:
+            queryset = self.filter(document_type=document_type)
+            if startkey is not None:
+                if startkey.startswith(prefix):
+                    queryset = queryset.filter(**{f"document_key__{start_lookup}": startkey[len(prefix):]})
+                elif comes_before(prefix, startkey):
+                    continue
+            if endkey is not None:
+                if endkey.startswith(prefix):
+                    queryset = queryset.filter(**{f"document_key__{end_lookup}": endkey[len(prefix):]})
+                elif comes_before(endkey, prefix):
+                    return
+
+            last_key = None
+            while True:
+                chunk_queryset = queryset
+                if last_key is not None:
+                    chunk_queryset = queryset.filter(**{f"document_key__{next_lookup}": last_key})
+
+                latest = list(chunk_queryset.values('document_key').annotate(last_id=Max('pk')).order_by(order).values_list('document_key', 'last_id')[:chunk_size])
+                if not latest:
+                    break
+
+                changes = self.in_bulk([last_id for _, last_id in latest])
+                for _, last_id in latest:
+                    yield changes[last_id]
+
+                last_key = latest[-1][0]
+
+    def get_superseded_changes(self, keep=1):
+        # the changes older than the latest keep changes of their document: the latest change is never superseded
+        kept = self.filter(document_type=OuterRef('document_type'), document_key=OuterRef('document_key')).order_by('-pk').values('pk')[keep - 1:keep]
+        return self.filter(pk__lt=Subquery(kept))
+
+    def count_documents(self, database=None, until=None):
+        # the documents not deleted, as of the change until when given
+        changes = self.for_database(database) if database is not None else self.all()
+        if until is not None:
+            changes = changes.filter(pk__lte=until)
+        return changes.filter(pk__in=Subquery(changes.values('document_type', 'document_key').annotate(last_id=Max('pk')).values('last_id')), deleted=False).count()
 
     def get_revisions_for_document(self, id):
-        return self.filter(document_id=id).values_list('revision', flat=True).order_by('-id')
+        return self.for_documents([id]).values_list('revision', flat=True).order_by('-id')
+
+    def get_revisions_for_change(self, change, limit=None):
+        revisions = self.filter(document_type=change.document_type_id, document_key=change.document_key).values_list('revision', flat=True).order_by('-id')
+        return revisions[:limit] if limit is not None else revisions
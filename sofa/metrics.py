@@ -0,0 +1,191 @@
+from bisect import bisect_left
+from contextvars import ContextVar
+from threading import Lock
+from time import perf_counter
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from .streaming import ContentTracker, tracking_view
+
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERIES_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._lock = Lock()
+        self._values = {}
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, *labels):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def collect(self):
+        with self._lock:
+            return [(self.name, labels, {}, value) for labels, value in self._values.items()]
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(labels)
+            if counts is None:
+                # a count for every bucket, +Inf, then the sum
+                counts = self._values[labels] = [0] * (len(self.buckets) + 1) + [0]
+            counts[index] += 1
+            counts[-1] += value
+
+    def collect(self):
+        samples = []
+        with self._lock:
+            values = {labels: list(counts) for labels, counts in self._values.items()}
+        for labels, counts in values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts[:-1]):
+                cumulative += count
+                samples.append((f"{self.name}_bucket", labels, {"le": str(bound)}, cumulative))
+            samples.append((f"{self.name}_sum", labels, {}, counts[-1]))
+            samples.append((f"{self.name}_count", labels, {}, cumulative))
+        return samples
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, *args, **kwargs):
+        return self.register(Counter(*args, **kwargs))
+
+    def histogram(self, *args, **kwargs):
+        return self.register(Histogram(*args, **kwargs))
+
+
+registry = Registry()
+
+request_duration = registry.histogram('sofa_request_duration_seconds', 'Time spent in a sofa view, streaming included', ('view',))
+request_queries = registry.histogram('sofa_request_queries', 'Database queries run by a sofa request', ('view',), buckets=QUERIES_BUCKETS)
+response_rows = registry.counter('sofa_response_rows_total', 'Rows (changes, documents, revisions) emitted by sofa views', ('view',))
+response_bytes = registry.counter('sofa_response_bytes_total', 'Bytes emitted by sofa views', ('view',))
+serialization_duration = registry.histogram('sofa_document_serialization_seconds', 'Time spent serializing a document', ('document',))
+documents_serialized = registry.counter('sofa_documents_serialized_total', 'Documents serialized', ('document',))
+changes_written = registry.counter('sofa_changes_written_total', 'Rows written to the change log', ('document',))
+documents_already_stored = registry.counter('sofa_documents_already_stored_total', 'Pushed documents skipped, their revision was already stored', ('document',))
+
+
+def is_enabled():
+    return getattr(settings, 'SOFA_METRICS_ENABLED', True)
+
+
+class RequestMetrics(ContentTracker):
+    def __init__(self, view):
+        self.view = view
+        self.queries = 0
+        self.rows = 0
+        self.bytes = 0
+        self.start = perf_counter()
+
+    def enter(self):
+        return _current_request.set(self)
+
+    def exit(self, token):
+        _current_request.reset(token)
+
+    def chunk(self, chunk):
+        self.bytes += len(chunk)
+
+    def close(self):
+        request_duration.observe(perf_counter() - self.start, self.view)
+        request_queries.observe(self.queries, self.view)
+        response_rows.inc(self.rows, self.view)
+        response_bytes.inc(self.bytes, self.view)
+
+
+_current_request = ContextVar('sofa_request_metrics', default=None)
+
+
+def count_queries(execute, sql, params, many, context):
+    # installed on every connection (see install), it only counts inside an instrumented view
+    request_metrics = _current_request.get()
+    if request_metrics is not None:
+        request_metrics.queries += 1
+    return execute(sql, params, many, context)
+
+
+def install_query_counter(connection, **kwargs):
+    if count_queries not in connection.execute_wrappers:
+        connection.execute_wrappers.append(count_queries)
+
+
+def install():
+    from django.db import connections
+    from django.db.backends.signals import connection_created
+    for connection in connections.all():
+        install_query_counter(connection)
+    connection_created.connect(install_query_counter, dispatch_uid='sofa_metrics_query_counter')
+
+
+def add_rows(count=1):
+    request_metrics = _current_request.get()
+    if request_metrics is not None:
+        request_metrics.rows += count
+
+
+def get_request_metrics(view, request):
+    return RequestMetrics(view) if is_enabled() else None
+
+
+def instrument_view(view_func):
+    return tracking_view(get_request_metrics)(view_func)
+
+
+class MetricsExporter:
+    content_type = 'text/plain; charset=utf-8'
+
+    def export(self, registry):
+        raise NotImplementedError
+
+
+class PrometheusExporter(MetricsExporter):
+    content_type = 'text/plain; version=0.0.4; charset=utf-8'
+
+    def format_labels(self, labelnames, labels, extra):
+        pairs = list(zip(labelnames, labels)) + list(extra.items())
+        if not pairs:
+            return ''
+        escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+        return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + '}'
+
+    def export(self, registry):
+        lines = []
+        for metric in registry.metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            for name, labels, extra, value in metric.collect():
+                lines.append(f"{name}{self.format_labels(metric.labelnames, labels, extra)} {value}")
+        return '\n'.join(lines) + '\n'
+
+
+def get_exporter():
+    return import_string(getattr(settings, 'SOFA_METRICS_EXPORTER', 'sofa.metrics.PrometheusExporter'))()
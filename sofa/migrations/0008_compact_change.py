@@ -0,0 +1,51 @@
+from django.db import migrations, models
+import django.db.models.deletion
+import sofa.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sofa', '0007_auto_20211020_1538'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DocumentType',
+            fields=[
+                ('id', models.SmallAutoField(primary_key=True, serialize=False)),
+                ('name', models.CharField(max_length=128, unique=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='change',
+            name='document_type',
+            field=models.ForeignKey(db_index=False, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='+', to='sofa.documenttype'),
+        ),
+        migrations.AddField(
+            model_name='change',
+            name='document_key',
+            field=models.CharField(blank=True, default='', max_length=128),
+        ),
+        migrations.AddField(
+            model_name='change',
+            name='compact_revision',
+            field=sofa.fields.RevisionField(null=True),
+        ),
+        migrations.AddField(
+            model_name='change',
+            name='is_deleted',
+            field=models.BooleanField(default=False),
+        ),
+        # the old columns are nullable, so that the migration can be reversed
+        migrations.AlterField(
+            model_name='change',
+            name='document_id',
+            field=models.CharField(db_index=True, max_length=128, null=True),
+        ),
+        migrations.AlterField(
+            model_name='change',
+            name='revision',
+            field=models.CharField(max_length=64, null=True),
+        ),
+    ]
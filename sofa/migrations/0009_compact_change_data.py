@@ -0,0 +1,77 @@
+import hashlib
+
+from django.db import migrations
+from django.db.models import Case, CharField, F, Value, When
+from django.db.models.functions import Concat, Left, StrIndex, Substr
+
+from sofa.fields import is_revision
+
+
+BATCH_SIZE = 5000
+
+
+def get_compact_revision(revision):
+    # revisions that can't be stored in 16 bytes are replaced by their md5, clients see them as a new revision
+    revision = str(revision)
+    return revision.lower() if is_revision(revision) else hashlib.md5(revision.encode()).hexdigest()
+
+
+def iter_batches(queryset):
+    last_id = 0
+    while True:
+        batch = list(queryset.filter(pk__gt=last_id).order_by('pk')[:BATCH_SIZE])
+        if not batch:
+            return
+        yield batch
+        last_id = batch[-1].pk
+
+
+def compact_changes(apps, schema_editor):
+    Change = apps.get_model('sofa', 'Change')
+    DocumentType = apps.get_model('sofa', 'DocumentType')
+    changes = Change.objects.using(schema_editor.connection.alias)
+
+    type_name = Case(
+        When(document_id__contains=':', then=Left('document_id', StrIndex('document_id', Value(':')) - 1)),
+        default=F('document_id'),
+        output_field=CharField(),
+    )
+    for name in changes.annotate(type_name=type_name).values_list('type_name', flat=True).distinct():
+        document_type, _ = DocumentType.objects.using(schema_editor.connection.alias).get_or_create(name=name)
+        changes.filter(document_id=name).update(document_type=document_type, document_key='')
+        changes.filter(document_id__startswith=f'{name}:').update(document_type=document_type, document_key=Substr('document_id', len(name) + 2))
+
+    changes.exclude(deleted=0).update(is_deleted=True)
+
+    for batch in iter_batches(changes.only('id', 'revision')):
+        for change in batch:
+            change.compact_revision = get_compact_revision(change.revision)
+        changes.bulk_update(batch, ['compact_revision'])
+
+
+def expand_changes(apps, schema_editor):
+    Change = apps.get_model('sofa', 'Change')
+    DocumentType = apps.get_model('sofa', 'DocumentType')
+    changes = Change.objects.using(schema_editor.connection.alias)
+
+    for document_type in DocumentType.objects.using(schema_editor.connection.alias):
+        changes.filter(document_type=document_type, document_key='').update(document_id=document_type.name)
+        changes.filter(document_type=document_type).exclude(document_key='').update(document_id=Concat(Value(f'{document_type.name}:'), 'document_key'))
+
+    changes.filter(is_deleted=True).update(deleted=1)
+
+    for batch in iter_batches(changes.only('id', 'compact_revision')):
+        for change in batch:
+            change.revision = change.compact_revision
+        changes.bulk_update(batch, ['revision'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sofa', '0008_compact_change'),
+    ]
+
+    operations = [
+        migrations.RunPython(compact_changes, expand_changes),
+    ]
@@ -0,0 +1,53 @@
+from django.db import migrations, models
+import django.db.models.deletion
+import sofa.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sofa', '0009_compact_change_data'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='change',
+            index_together=set(),
+        ),
+        migrations.RemoveField(
+            model_name='change',
+            name='document_id',
+        ),
+        migrations.RemoveField(
+            model_name='change',
+            name='revision',
+        ),
+        migrations.RemoveField(
+            model_name='change',
+            name='deleted',
+        ),
+        migrations.RenameField(
+            model_name='change',
+            old_name='compact_revision',
+            new_name='revision',
+        ),
+        migrations.RenameField(
+            model_name='change',
+            old_name='is_deleted',
+            new_name='deleted',
+        ),
+        migrations.AlterField(
+            model_name='change',
+            name='document_type',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.PROTECT, related_name='+', to='sofa.documenttype'),
+        ),
+        migrations.AlterField(
+            model_name='change',
+            name='revision',
+            field=sofa.fields.RevisionField(),
+        ),
+        migrations.AddIndex(
+            model_name='change',
+            index=models.Index(fields=['document_type', 'document_key', 'revision'], name='sofa_change_document_rev_idx'),
+        ),
+    ]
@@ -0,0 +1,34 @@
+from django.db import migrations, models
+
+
+class PostgreSQLRunSQL(migrations.RunSQL):
+    # postgresql only variants of the indexes in the models state
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.vendor == 'postgresql':
+            super().database_forwards(app_label, schema_editor, from_state, to_state)
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.vendor == 'postgresql':
+            super().database_backwards(app_label, schema_editor, from_state, to_state)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sofa', '0010_compact_change_cleanup'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='change',
+            index=models.Index(fields=['document_type', 'document_key', 'id'], name='sofa_change_document_seq_idx'),
+        ),
+        # postgresql can answer the revisions of a document and the latest changes from the index alone (index only scan)
+        PostgreSQLRunSQL(
+            'DROP INDEX "sofa_change_document_seq_idx"; '
+            'CREATE INDEX "sofa_change_document_seq_idx" ON "sofa_change" ("document_type_id", "document_key", "id") INCLUDE ("revision", "deleted")',
+            'DROP INDEX "sofa_change_document_seq_idx"; '
+            'CREATE INDEX "sofa_change_document_seq_idx" ON "sofa_change" ("document_type_id", "document_key", "id")',
+        ),
+    ]
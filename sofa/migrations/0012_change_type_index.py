@@ -0,0 +1,17 @@
+# Generated by Django 4.2.30 on 2026-10-19 11:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sofa', '0011_change_indexes'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='change',
+            index=models.Index(fields=['document_type', 'id'], name='sofa_change_type_seq_idx'),
+        ),
+    ]
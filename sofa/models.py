@@ -1,21 +1,62 @@
 from django.contrib.contenttypes.models import ContentType
-from django.db import models
+from functools import partial
 
-from sofa.loader import get_class_by_document_id
-from .managers import ChangeManager
+from django.db import models, transaction
+
+from sofa.loader import get_class_by_document_id, get_database_by_document_id, split_document_id, join_document_id
+from .fields import RevisionField
+from .managers import ChangeManager, DocumentTypeManager
+from .metrics import changes_written
+from .sequence import get_update_seq
+
+
+class DocumentType(models.Model):
+    id = models.SmallAutoField(primary_key=True)
+    # the Meta.document_id of a document class
+    name = models.CharField(max_length=128, unique=True)
+
+    objects = DocumentTypeManager()
 
 
 class Change(models.Model):
-    document_id = models.CharField(max_length=128, db_index=True)
-    revision = models.CharField(max_length=64)
+    # the document id is split in its type and its key, empty for single documents (see the document_id property)
+    document_type = models.ForeignKey(DocumentType, related_name='+', on_delete=models.PROTECT, db_index=False)
+    document_key = models.CharField(max_length=128, blank=True, default='')
+    revision = RevisionField()
 
     #TODO: what to do when the document class is deleted. Probably we should set deleted to true... how?
-    deleted = models.PositiveIntegerField(default=0)
+    deleted = models.BooleanField(default=False)
 
     objects = ChangeManager()
 
     class Meta:
-        index_together = (('document_id', 'revision'),)
+        indexes = [
+            models.Index(fields=['document_type', 'document_key', 'revision'], name='sofa_change_document_rev_idx'),
+            # latest change and revisions of a document, keys of a document type in order (see ChangeManager)
+            models.Index(fields=['document_type', 'document_key', 'id'], name='sofa_change_document_seq_idx'),
+            # the log of a document type in order: per type changes feed, logs of the databases and maintenance
+            models.Index(fields=['document_type', 'id'], name='sofa_change_type_seq_idx'),
+        ]
+
+    def get_document_type(self):
+        # the related document type when already loaded (e.g. select_related), the cached one otherwise
+        if Change.document_type.is_cached(self):
+            return self.document_type
+        return DocumentType.objects.get_for_id(self.document_type_id)
+
+    @property
+    def document_id(self):
+        return join_document_id(self.get_document_type().name, self.document_key)
+
+    @document_id.setter
+    def document_id(self, value):
+        name, self.document_key = split_document_id(value)
+        self.document_type = DocumentType.objects.get_or_create_for_name(name)
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        changes_written.inc(1, self.get_document_type().name)
+        transaction.on_commit(partial(get_update_seq(get_database_by_document_id(self.document_id)).advance, self.pk), using=self._state.db)
 
     def get_document(self, request):
         document_class = get_class_by_document_id(self.document_id)
@@ -32,3 +73,8 @@ class ReplicationHistory(models.Model):
     replication_log = models.ForeignKey(ReplicationLog, related_name='history', on_delete=models.CASCADE)
     session_id = models.CharField(max_length=64)
     last_seq = models.PositiveIntegerField()
+
+    @property
+    def revision(self):
+        # the entry of a session is written again at every checkpoint, so the revision follows its last_seq
+        return f"{self.pk}.{self.last_seq}"
@@ -0,0 +1,143 @@
+import cProfile
+import json
+import os
+from contextlib import contextmanager
+from contextvars import ContextVar
+from threading import Lock
+from time import perf_counter, time
+from uuid import uuid4
+
+from django.conf import settings
+from django.core import signing
+
+from .streaming import ContentTracker, tracking_view
+
+
+PROFILE_HEADER = 'HTTP_X_SOFA_PROFILE'
+PROFILE_SALT = 'sofa.profiling'
+
+# cProfile profiles one request at a time: on Python 3.12+ enabling a profiler while another one is active raises
+_profiler_lock = Lock()
+
+
+def get_profile_token():
+    # value of the X-Sofa-Profile header enabling the profiling of a request
+    return signing.dumps('profile', salt=PROFILE_SALT)
+
+
+def is_profiling_requested(request):
+    if not getattr(settings, 'SOFA_PROFILE_DIR', None):
+        return False
+    if getattr(settings, 'SOFA_PROFILE_ALL', False):
+        return True
+    token = request.META.get(PROFILE_HEADER)
+    if not token:
+        return False
+    try:
+        signing.loads(token, salt=PROFILE_SALT, max_age=getattr(settings, 'SOFA_PROFILE_TOKEN_MAX_AGE', 3600))
+    except signing.BadSignature:
+        return False
+    return True
+
+
+class RequestProfile(ContentTracker):
+    def __init__(self, view, request, profiler=True):
+        self.view = view
+        self.method = request.method
+        self.path = request.get_full_path()
+        self.profiler = cProfile.Profile() if profiler else None
+        # whether the cProfile dump covers the whole request, and any of it
+        self.complete = profiler
+        self.profiled = False
+        self.phases = {}
+        # the documents of a request can be serialized by a thread pool (SOFA_BULK_GET_WORKERS)
+        self.lock = Lock()
+        self.started_at = time()
+        self.start = perf_counter()
+
+    def add_phase(self, name, elapsed):
+        with self.lock:
+            phase = self.phases.setdefault(name, {"seconds": 0.0, "calls": 0})
+            phase["seconds"] += elapsed
+            phase["calls"] += 1
+
+    def enable_profiler(self):
+        if self.profiler is None:
+            return False
+        if _profiler_lock.acquire(blocking=False):
+            try:
+                self.profiler.enable()
+                self.profiled = True
+                return True
+            except ValueError:
+                # another profiling tool (debugger, coverage...)
+                _profiler_lock.release()
+        # another request is profiled: only the phases are timed meanwhile
+        self.complete = False
+        return False
+
+    def enter(self):
+        return _current_profile.set(self), self.enable_profiler()
+
+    def exit(self, state):
+        token, enabled = state
+        if enabled:
+            self.profiler.disable()
+            _profiler_lock.release()
+        _current_profile.reset(token)
+
+    def close(self):
+        self.save()
+
+    def save(self):
+        directory = settings.SOFA_PROFILE_DIR
+        os.makedirs(directory, exist_ok=True)
+        basename = os.path.join(directory, f"{int(self.started_at * 1000)}-{self.view}-{os.getpid()}-{uuid4().hex}")
+        if self.profiled:
+            self.profiler.dump_stats(f"{basename}.prof")
+        with open(f"{basename}.json", 'w') as f:
+            json.dump({
+                "view": self.view,
+                "method": self.method,
+                "path": self.path,
+                "started_at": self.started_at,
+                "seconds": perf_counter() - self.start,
+                "cprofile": "complete" if self.complete else "partial" if self.profiled else "none",
+                "phases": self.phases,
+            }, f, indent=2)
+
+
+_current_profile = ContextVar('sofa_request_profile', default=None)
+
+
+@contextmanager
+def phase(name):
+    # times a block of the profiled request, a no-op for every other request
+    profile = _current_profile.get()
+    if profile is None:
+        yield
+        return
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        profile.add_phase(name, perf_counter() - start)
+
+
+def get_request_profile(view, request):
+    return RequestProfile(view, request) if is_profiling_requested(request) else None
+
+
+async def aget_request_profile(view, request):
+    # an async view is not profiled by cProfile, enabled across its awaits it would profile the other requests of
+    # the event loop as well: only its phases are timed
+    return RequestProfile(view, request, profiler=False) if is_profiling_requested(request) else None
+
+
+def profile_view(view_func):
+    """
+    Profile the view, and its streaming content, when SOFA_PROFILE_DIR is set and the request has a valid
+    X-Sofa-Profile header (see get_profile_token) or SOFA_PROFILE_ALL is true.
+    A cProfile dump (.prof, sync views only) and the timing of the phases (.json) are written to SOFA_PROFILE_DIR.
+    """
+    return tracking_view(get_request_profile, aget_request_profile)(view_func)
@@ -0,0 +1,188 @@
+import asyncio
+import random
+from contextvars import ContextVar
+from functools import wraps
+from time import monotonic, sleep
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, DatabaseError
+from django.db.models import Max
+
+from .clients import get_client_key
+from .streaming import ContentTracker, tracking_view
+
+
+class ReadDatabase(ContentTracker):
+    def __init__(self, alias, seq=None):
+        self.alias = alias
+        # the highest change visible on the replica when it was chosen, None for the primary
+        self.seq = seq
+
+    def enter(self):
+        return _read_database.set(self)
+
+    def exit(self, token):
+        _read_database.reset(token)
+
+
+_read_database = ContextVar('sofa_read_database', default=None)
+
+# highest change seen on every replica, it only grows
+_replica_seqs = {}
+
+
+def get_replica_databases():
+    return getattr(settings, 'SOFA_REPLICA_DATABASES', [])
+
+
+def get_primary_database():
+    return getattr(settings, 'SOFA_PRIMARY_DATABASE', DEFAULT_DB_ALIAS)
+
+
+def get_read_database():
+    return _read_database.get()
+
+
+def get_client_seq_key(request):
+    return f"sofa:client_seq:{get_client_key(request)}"
+
+
+def get_client_seq(request):
+    return cache.get(get_client_seq_key(request), 0)
+
+
+def remember_client_seq(request, seq):
+    # the next reads of the client need a database with this change: its own write, or the last_seq it received
+    if not get_replica_databases():
+        return
+    key = get_client_seq_key(request)
+    if cache.get(key, 0) < seq:
+        cache.set(key, seq, getattr(settings, 'SOFA_REPLICA_CLIENT_TIMEOUT', 300))
+
+
+def query_database_seq(alias):
+    from .models import Change
+    return Change.objects.using(alias).aggregate(last_id=Max('id'))['last_id'] or 0
+
+
+def get_replica_seq(alias, required_seq):
+    seq = _replica_seqs.get(alias, 0)
+    if seq < required_seq:
+        try:
+            seq = _replica_seqs[alias] = max(query_database_seq(alias), seq)
+        except DatabaseError:
+            # an unavailable replica is skipped
+            return None
+    return seq
+
+
+async def aget_replica_seq(alias, required_seq):
+    seq = _replica_seqs.get(alias, 0)
+    if seq < required_seq:
+        try:
+            seq = _replica_seqs[alias] = max(await sync_to_async(query_database_seq)(alias), seq)
+        except DatabaseError:
+            return None
+    return seq
+
+
+def get_since(request):
+    try:
+        return int(request.GET.get('since', '0'))
+    except ValueError:
+        return 0
+
+
+def get_required_seq(request):
+    return max(get_since(request), get_client_seq(request))
+
+
+def get_replica_wait_deadline():
+    return monotonic() + getattr(settings, 'SOFA_REPLICA_WAIT', 0.5)
+
+
+def get_replica_poll_interval():
+    return getattr(settings, 'SOFA_REPLICA_POLL_INTERVAL', 0.05)
+
+
+def choose_read_database(request):
+    """
+    A replica having all the changes the request can depend on: the since of _changes, the last write of the client
+    and the last_seq it received. Replicas are polled for SOFA_REPLICA_WAIT seconds, then the primary is used.
+    """
+    replicas = get_replica_databases()
+    if not replicas:
+        return None
+
+    required_seq = get_required_seq(request)
+    deadline = get_replica_wait_deadline()
+    while True:
+        for alias in random.sample(replicas, len(replicas)):
+            seq = get_replica_seq(alias, required_seq)
+            if seq is not None and seq >= required_seq:
+                return ReadDatabase(alias, seq)
+        if monotonic() >= deadline:
+            return ReadDatabase(get_primary_database())
+        sleep(get_replica_poll_interval())
+
+
+async def achoose_read_database(request):
+    # choose_read_database for the async views: the event loop keeps serving the other requests while the replicas
+    # catch up, only the queries run in a thread
+    replicas = get_replica_databases()
+    if not replicas:
+        return None
+
+    # the client key can load the user of the session
+    required_seq = await sync_to_async(get_required_seq)(request)
+    deadline = get_replica_wait_deadline()
+    while True:
+        for alias in random.sample(replicas, len(replicas)):
+            seq = await aget_replica_seq(alias, required_seq)
+            if seq is not None and seq >= required_seq:
+                return ReadDatabase(alias, seq)
+        if monotonic() >= deadline:
+            return ReadDatabase(get_primary_database())
+        await asyncio.sleep(get_replica_poll_interval())
+
+
+def get_read_database_tracker(view, request):
+    return choose_read_database(request)
+
+
+async def aget_read_database_tracker(view, request):
+    return await achoose_read_database(request)
+
+
+def replica_view(view_func):
+    """
+    Run the reads of the view, and of its streaming content, on the database chosen by choose_read_database.
+    Requires ReplicaRouter in DATABASE_ROUTERS and the replica aliases in SOFA_REPLICA_DATABASES.
+    """
+    return tracking_view(get_read_database_tracker, aget_read_database_tracker)(view_func)
+
+
+def primary_write_view(view_func):
+    # the client must read its own writes: its next reads wait for a replica having them, or go to the primary
+    @wraps(view_func)
+    def wrapped_view(request, *args, **kwargs):
+        response = view_func(request, *args, **kwargs)
+        if request.method == 'POST' and get_replica_databases():
+            remember_client_seq(request, query_database_seq(get_primary_database()))
+        return response
+    return wrapped_view
+
+
+class ReplicaRouter:
+    """
+    Sends the reads of the replication views to the database chosen for the request (see replica_view),
+    every other query is left to the next routers.
+    """
+
+    def db_for_read(self, model, **hints):
+        read_database = _read_database.get()
+        if read_database is not None:
+            return read_database.alias
+        return None
@@ -0,0 +1,73 @@
+from threading import Lock
+from time import monotonic
+
+from django.conf import settings
+from django.core.cache import cache
+
+from .loader import DEFAULT_DATABASE
+
+
+class SequenceTracker:
+    """
+    Keeps track of the highest Change id (the CouchDB update_seq) without querying the change log on every read.
+    The value is kept in memory for SOFA_SEQUENCE_TIMEOUT seconds and shared between processes through the default cache.
+    """
+
+    def __init__(self, cache_key, database):
+        self.cache_key = cache_key
+        self.database = database
+        self._lock = Lock()
+        self._value = 0
+        self._expires_at = 0
+
+    @property
+    def timeout(self):
+        return getattr(settings, 'SOFA_SEQUENCE_TIMEOUT', 5)
+
+    def query_last_seq(self):
+        from .models import Change
+        return Change.objects.get_last_id(self.database)
+
+    def get_last_seq(self):
+        if monotonic() < self._expires_at:
+            return self._value
+
+        value = cache.get(self.cache_key)
+        if value is None:
+            value = self.query_last_seq()
+            cache.set(self.cache_key, value, self.timeout)
+
+        with self._lock:
+            self._value = max(self._value, value)
+            self._expires_at = monotonic() + self.timeout
+            return self._value
+
+    def clear(self):
+        # forget the value read, the next reader loads it again (the log was rewritten, by tests for instance)
+        with self._lock:
+            self._value = 0
+            self._expires_at = 0
+
+    def advance(self, seq):
+        with self._lock:
+            self._value = max(self._value, seq)
+
+        # a missing key is left missing: the next reader loads the real value from the db.
+        # Storing our seq could hide a higher one written by another process.
+        current = cache.get(self.cache_key)
+        if current is not None and current < seq:
+            cache.set(self.cache_key, seq, self.timeout)
+
+
+update_seq = SequenceTracker('sofa:update_seq', DEFAULT_DATABASE)
+
+_trackers = {DEFAULT_DATABASE: update_seq}
+_trackers_lock = Lock()
+
+
+def get_update_seq(database):
+    # every database has its own update_seq: the highest change of its partition of the log
+    if database not in _trackers:
+        with _trackers_lock:
+            _trackers.setdefault(database, SequenceTracker(f'sofa:update_seq:{database}', database))
+    return _trackers[database]
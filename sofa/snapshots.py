@@ -0,0 +1,124 @@
+import gzip
+import json
+import os
+import re
+
+from django.conf import settings
+
+from .base import document_renderer, iter_documents_content
+from .loader import get_class_by_document_id, get_database_document_types, join_document_id
+from .models import Change, DocumentType
+
+
+SNAPSHOT_NAME = re.compile(r'^(?P<db_name>.+)-(?P<seq>\d+)\.ndjson\.gz$')
+
+
+def get_snapshot_dir():
+    return getattr(settings, 'SOFA_SNAPSHOT_DIR', None)
+
+
+def get_snapshot_path(db_name, seq):
+    return os.path.join(get_snapshot_dir(), f"{db_name}-{seq}.ndjson.gz")
+
+
+def get_snapshots(db_name):
+    # the (seq, path) of the snapshots of the database, the latest first
+    directory = get_snapshot_dir()
+    if not directory or not os.path.isdir(directory):
+        return []
+    snapshots = []
+    for name in os.listdir(directory):
+        match = SNAPSHOT_NAME.match(name)
+        if match and match['db_name'] == db_name:
+            snapshots.append((int(match['seq']), os.path.join(directory, name)))
+    return sorted(snapshots, reverse=True)
+
+
+def get_latest_snapshot(db_name):
+    snapshots = get_snapshots(db_name)
+    return snapshots[0] if snapshots else (None, None)
+
+
+def render_line(content):
+    return document_renderer.render(content) + b'\n'
+
+
+def get_snapshot_document_types(db_name):
+    # the document classes of the database with Meta.snapshot: the other ones are replicated through _changes
+    return [name for name in get_database_document_types(db_name) if get_class_by_document_id(name).is_snapshot_document()]
+
+
+def get_snapshot_header(path):
+    with gzip.open(path, 'rb') as snapshot:
+        return json.loads(next(snapshot))
+
+
+def iter_all_documents(document_types):
+    # the latest change of every document of the types, deleted documents aren't part of a snapshot
+    from .views import get_document_info
+    latest_changes = Change.objects.iter_latest_changes(document_types=document_types, chunk_size=1000)
+    return ((change.document_id, get_document_info(change)) for change in latest_changes if not change.deleted)
+
+
+def get_changed_documents(document_types, since, seq):
+    # the latest change of the documents changed between two snapshots
+    from .views import get_document_info
+    keys = Change.objects.for_document_types(document_types).filter(pk__gt=since, pk__lte=seq).values_list('document_type', 'document_key').distinct()
+    ids = [join_document_id(DocumentType.objects.get_for_id(document_type).name, key) for document_type, key in keys]
+    return [(change.document_id, get_document_info(change)) for change in Change.objects.get_latest_changes(ids)]
+
+
+def iter_snapshot_lines(previous_path, changed_documents):
+    # the documents of the previous snapshot are copied as they are, only the changed documents are serialized again
+    changed_ids = {doc_id for doc_id, _ in changed_documents}
+    if previous_path is not None:
+        with gzip.open(previous_path, 'rb') as previous:
+            next(previous)  # header
+            for line in previous:
+                if json.loads(line)['_id'] not in changed_ids:
+                    yield line
+    documents = (document for document in changed_documents if not document[1]['deleted'])
+    for _, content in iter_documents_content(None, documents, False):
+        yield render_line(content)
+
+
+def build_snapshot(db_name, incremental=True, keep=2):
+    """
+    Write a snapshot of the current documents of the database in SOFA_SNAPSHOT_DIR, as of the latest change:
+    gzipped NDJSON, a header ({"db_name", "seq", "document_types"}) then a document per line. Only the document
+    classes with Meta.snapshot are included. The previous snapshot is the base of the new one (see
+    iter_snapshot_lines) unless incremental is false. Returns (seq, path, documents).
+    """
+    document_types = get_snapshot_document_types(db_name)
+    seq = Change.objects.get_last_id(db_name)
+    previous_seq, previous_path = get_latest_snapshot(db_name) if incremental else (None, None)
+    if previous_path is not None and get_snapshot_header(previous_path).get('document_types') != document_types:
+        # the snapshot classes changed: the previous snapshot misses documents, or has documents no longer shared
+        previous_seq, previous_path = None, None
+    if previous_seq == seq:
+        return seq, previous_path, None
+    if previous_seq is not None and previous_seq > seq:
+        # the log was reset (e.g. sofa_init_revision): the previous snapshot has unknown revisions
+        previous_path = None
+
+    if previous_path is not None:
+        lines = iter_snapshot_lines(previous_path, get_changed_documents(document_types, previous_seq, seq))
+    else:
+        # built once for every client: there is no request, see DocumentBase.check_snapshot
+        lines = (render_line(content) for _, content in iter_documents_content(None, iter_all_documents(document_types), False))
+
+    os.makedirs(get_snapshot_dir(), exist_ok=True)
+    path = get_snapshot_path(db_name, seq)
+    documents = 0
+    # written aside and renamed: a snapshot being downloaded is never changed
+    with gzip.open(f"{path}.tmp", 'wb') as snapshot:
+        snapshot.write(json.dumps({"db_name": db_name, "seq": seq, "document_types": document_types}).encode('utf-8') + b'\n')
+        for line in lines:
+            snapshot.write(line)
+            documents += 1
+    os.replace(f"{path}.tmp", path)
+
+    # the previous snapshots are kept for the downloads still running
+    for _, old_path in get_snapshots(db_name)[keep:]:
+        os.remove(old_path)
+    return seq, path, documents
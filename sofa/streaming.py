@@ -0,0 +1,151 @@
+import asyncio
+from functools import partial, wraps
+
+from django.http.response import HttpResponseBase
+
+
+class ContentTracker:
+    """
+    The state of a request kept until its response is sent (metrics, profile, read database, admission slot).
+    enter/exit run around the view and around every chunk of its streaming content (e.g. to set a ContextVar),
+    chunk sees every chunk (the whole content of a response not streaming), close is called once at the end.
+    """
+
+    def enter(self):
+        return None
+
+    def exit(self, state):
+        pass
+
+    def chunk(self, chunk):
+        pass
+
+    def close(self):
+        pass
+
+
+class BaseTrackedContent:
+    # a class and not a generator: the response registers close() as a closer, called when the client is gone
+    def __init__(self, tracker):
+        self.tracker = tracker
+        self.closed = False
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.tracker.close()
+
+
+class TrackedContent(BaseTrackedContent):
+    def __init__(self, tracker, streaming_content):
+        super().__init__(tracker)
+        self.iterator = iter(streaming_content)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        state = self.tracker.enter()
+        try:
+            chunk = next(self.iterator)
+        except StopIteration:
+            self.tracker.exit(state)
+            self.close()
+            raise
+        except BaseException:
+            self.tracker.exit(state)
+            raise
+        self.tracker.exit(state)
+        self.tracker.chunk(chunk)
+        return chunk
+
+
+class AsyncTrackedContent(BaseTrackedContent):
+    # not iterable: the response tells async content from its lack of __iter__
+    def __init__(self, tracker, streaming_content):
+        super().__init__(tracker)
+        self.iterator = streaming_content.__aiter__()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        state = self.tracker.enter()
+        try:
+            chunk = await self.iterator.__anext__()
+        except StopAsyncIteration:
+            self.tracker.exit(state)
+            self.close()
+            raise
+        except BaseException:
+            self.tracker.exit(state)
+            raise
+        self.tracker.exit(state)
+        self.tracker.chunk(chunk)
+        return chunk
+
+
+def wrap_streaming_content(response, wrapper, async_wrapper):
+    # the streaming content of the response replaced by wrapper(content), async_wrapper(content) for async content
+    if response.is_async:
+        response.streaming_content = async_wrapper(response.streaming_content)
+    else:
+        response.streaming_content = wrapper(response.streaming_content)
+    return response
+
+
+def track_response(tracker, response):
+    # the view is done only when its streaming content is consumed
+    if response.streaming:
+        return wrap_streaming_content(response, partial(TrackedContent, tracker), partial(AsyncTrackedContent, tracker))
+    tracker.chunk(response.content)
+    tracker.close()
+    return response
+
+
+def tracking_view(get_tracker, aget_tracker=None):
+    """
+    Run the view (sync or async), and its streaming content, within the tracker returned by
+    get_tracker(view name, request), aget_tracker for async views when given. A None tracker leaves the request
+    alone, a response is returned instead of calling the view.
+    """
+    def decorator(view_func):
+        name = view_func.__name__
+
+        if asyncio.iscoroutinefunction(view_func):
+            @wraps(view_func)
+            async def async_wrapped_view(request, *args, **kwargs):
+                tracker = await aget_tracker(name, request) if aget_tracker is not None else get_tracker(name, request)
+                if tracker is None:
+                    return await view_func(request, *args, **kwargs)
+                if isinstance(tracker, HttpResponseBase):
+                    return tracker
+                state = tracker.enter()
+                try:
+                    response = await view_func(request, *args, **kwargs)
+                except BaseException:
+                    tracker.exit(state)
+                    tracker.close()
+                    raise
+                tracker.exit(state)
+                return track_response(tracker, response)
+            return async_wrapped_view
+
+        @wraps(view_func)
+        def wrapped_view(request, *args, **kwargs):
+            tracker = get_tracker(name, request)
+            if tracker is None:
+                return view_func(request, *args, **kwargs)
+            if isinstance(tracker, HttpResponseBase):
+                return tracker
+            state = tracker.enter()
+            try:
+                response = view_func(request, *args, **kwargs)
+            except BaseException:
+                tracker.exit(state)
+                tracker.close()
+                raise
+            tracker.exit(state)
+            return track_response(tracker, response)
+        return wrapped_view
+    return decorator
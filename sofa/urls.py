@@ -1,14 +1,17 @@
 from django.urls import path
-from .views import database, index, replication_log, changes, all_docs, bulk_get, revs_diff, document, bulk_docs
+from .views import database, index, replication_log, changes, all_docs, bulk_get, revs_diff, document, bulk_docs, snapshot, metrics
 
 urlpatterns = [
     path('', index),
-    path('db/', database),
-    path('db/_local/<replication_id>', replication_log),
-    path('db/_changes', changes),
-    path('db/_all_docs', all_docs),
-    path('db/_bulk_get', bulk_get),
-    path('db/_revs_diff', revs_diff),
-    path('db/<document_id>', document),
-    path('db/_bulk_docs', bulk_docs),
+    path('_metrics', metrics),
+    path('<db_name>/', database),
+    path('<db_name>/_local/<replication_id>', replication_log),
+    path('<db_name>/_changes', changes),
+    path('<db_name>/_all_docs', all_docs),
+    path('<db_name>/_bulk_get', bulk_get),
+    path('<db_name>/_revs_diff', revs_diff),
+    path('<db_name>/_snapshot', snapshot),
+    path('<db_name>/_bulk_docs', bulk_docs),
+    # after the _ routes, which it would match as well
+    path('<db_name>/<document_id>', document),
 ]
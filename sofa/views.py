@@ -1,16 +1,31 @@
+import asyncio
 import json
+import os
+import re
+from functools import wraps
+from itertools import chain, islice
 
+from django.core.cache import cache
 from django.db import transaction
-from django.db.models import Max, CharField, Q, Value, Subquery
-from django.db.models.functions import Cast, Concat
-from django.http import JsonResponse, HttpResponseForbidden, HttpResponse, HttpResponseNotFound, StreamingHttpResponse, HttpResponseBadRequest
+from django.db.models import Exists, OuterRef, Q
+from django.http import JsonResponse, HttpResponseForbidden, HttpResponse, HttpResponseNotFound, StreamingHttpResponse, HttpResponseBadRequest, HttpResponseNotModified, FileResponse
 from django.views.decorators.cache import cache_control
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_http_methods
 from django.utils import timezone
+from django.utils.http import parse_etags
 import hashlib
-from .loader import get_class_by_document_id
-from .models import Change, ReplicationLog, ReplicationHistory
+from .base import document_renderer, iter_documents_content, iter_documents_chunks_content
+from .loader import get_class_by_document_id, split_document_id, get_databases, get_database_document_types, get_database_by_document_id, filter_database_document_ids
+from .metrics import instrument_view, add_rows, registry, get_exporter, documents_already_stored
+from .admission import admission_view
+from .compression import compress_view
+from .profiling import profile_view, phase
+from .routers import replica_view, primary_write_view, get_read_database, remember_client_seq
+from .fields import is_revision
+from .models import Change, DocumentType, ReplicationLog, ReplicationHistory
+from .sequence import get_update_seq
+from .snapshots import get_latest_snapshot
 from django.conf import settings
 
 
@@ -18,6 +33,31 @@ start_time = int(timezone.now().timestamp() * 1000 * 1000)
 server_uuid = hashlib.sha1(settings.SECRET_KEY.encode()).hexdigest()[:32]
 
 
+def database_not_found():
+    return HttpResponseNotFound(json.dumps({"error": "not_found", "reason": "Database does not exist."}), content_type='application/json')
+
+
+def database_view(view_func):
+    """
+    Serve the view for the logical databases only (the Meta.database of the document classes, db by default),
+    the others are not found. The database is the db_name argument of the view.
+    """
+    if asyncio.iscoroutinefunction(view_func):
+        @wraps(view_func)
+        async def async_wrapped_view(request, db_name, *args, **kwargs):
+            if db_name not in get_databases():
+                return database_not_found()
+            return await view_func(request, db_name, *args, **kwargs)
+        return async_wrapped_view
+
+    @wraps(view_func)
+    def wrapped_view(request, db_name, *args, **kwargs):
+        if db_name not in get_databases():
+            return database_not_found()
+        return view_func(request, db_name, *args, **kwargs)
+    return wrapped_view
+
+
 @require_http_methods(["GET"])
 @cache_control(must_revalidate=True)
 def index(request):
@@ -31,10 +71,12 @@ def index(request):
     })
 
 
+@instrument_view
+@database_view
 @require_http_methods(['HEAD', 'PUT', 'GET'])
 @csrf_exempt
 @cache_control(must_revalidate=True)
-def database(request):
+def database(request, db_name):
     if request.method == 'HEAD':
         return HttpResponse(content_type='application/json')
     if request.method == 'PUT':
@@ -43,13 +85,10 @@ def database(request):
             "reason": "unauthorized to create database {}".format(request.build_absolute_uri())
         }), content_type='application/json')
     if request.method == 'GET':
-        last_id = 0
-        try:
-            last_id = Change.objects.latest('id').id
-        except Change.DoesNotExist:
-            pass
+        last_id = get_update_seq(db_name).get_last_seq()
 
         return JsonResponse({
+            "db_name": db_name,
             "instance_start_time": start_time,
             "update_seq": last_id,
             "committed_update_seq": last_id,
@@ -61,162 +100,355 @@ def database(request):
         })
 
 
-@require_http_methods(['GET', 'PUT'])
-@csrf_exempt
-@cache_control(must_revalidate=True)
-def replication_log(request, replication_id):
-    # TODO: generate ETag
-    if request.method == 'PUT':
-        body = json.loads(request.body.decode('utf-8'))
-        with transaction.atomic():
-            rep_log, _ = ReplicationLog.objects.get_or_create(
-                document_id=replication_id,
-                defaults={
-                    'version': body['version'],
-                    'replicator': body['replicator']
-                }
-            )
-            last_history = ReplicationHistory.objects.create(
-                    replication_log=rep_log,
-                    session_id=body['session_id'],
-                    last_seq=body['last_seq']
-            )
+def get_replication_history_limit():
+    return getattr(settings, 'SOFA_REPLICATION_HISTORY_LIMIT', 50)
 
-        return JsonResponse({
-            "_id": f"_local/{rep_log.document_id}",
-            "_rev": f"1-{last_history.pk}",
-            "ok": True
-        }, status=201)
 
-    try:
-        rep_log = ReplicationLog.objects.prefetch_related('history').get(document_id=replication_id)
-        last_history = rep_log.history.latest('id')
-        return JsonResponse({
+def save_replication_log(replication_id, body):
+    # a checkpoint updates the history entry of its replication session and only the latest sessions are kept
+    with transaction.atomic():
+        rep_log, _ = ReplicationLog.objects.select_for_update().get_or_create(
+            document_id=replication_id,
+            defaults={
+                'version': body['version'],
+                'replicator': body['replicator']
+            }
+        )
+        # the entry of the session is written again: the history in id order is the sessions by latest checkpoint,
+        # so an active session is neither listed after idle ones nor pruned before them
+        rep_log.history.filter(session_id=body['session_id']).delete()
+        last_history = ReplicationHistory.objects.create(
+                replication_log=rep_log,
+                session_id=body['session_id'],
+                last_seq=body['last_seq']
+        )
+
+        limit = get_replication_history_limit()
+        oldest_to_delete = rep_log.history.order_by('-id').values_list('id', flat=True)[limit:limit + 1]
+        if oldest_to_delete:
+            rep_log.history.filter(id__lte=oldest_to_delete[0]).delete()
+
+    return rep_log, last_history
+
+
+def get_replication_history(replication_id):
+    # the latest sessions first, with their replication log, in a single query
+    return ReplicationHistory.objects.select_related('replication_log').filter(
+        replication_log__document_id=replication_id
+    ).order_by('-id')[:get_replication_history_limit()]
+
+
+def get_replication_log_etag(last_history):
+    return f'"1-{last_history.revision}"'
+
+
+def get_replication_log_response(request, history):
+    if not history:
+        return replication_log_not_found()
+
+    last_history = history[0]
+    rep_log = last_history.replication_log
+    etag = get_replication_log_etag(last_history)
+
+    if etag in parse_etags(request.META.get('HTTP_IF_NONE_MATCH', '')):
+        response = HttpResponseNotModified()
+    else:
+        response = JsonResponse({
             "_id": f"_local/{rep_log.document_id}",
-            "_rev": f"1-{last_history.pk}",
-            "history": [{"last_seq": h.last_seq, "session_id": h.session_id} for h in rep_log.history.all()],
+            "_rev": f"1-{last_history.revision}",
+            "history": [{"last_seq": h.last_seq, "session_id": h.session_id} for h in history],
             "session_id": last_history.session_id,
             "last_seq": last_history.last_seq,
             "replicator": rep_log.replicator,
             "version": rep_log.version
         })
-    except ReplicationLog.DoesNotExist:
-        return HttpResponseNotFound(json.dumps({"error": "not_found", "reason": "missing"}), content_type='application/json')
+    response['ETag'] = etag
+    return response
+
+
+def get_replication_log_saved_response(rep_log, last_history):
+    response = JsonResponse({
+        "_id": f"_local/{rep_log.document_id}",
+        "_rev": f"1-{last_history.revision}",
+        "ok": True
+    }, status=201)
+    response['ETag'] = get_replication_log_etag(last_history)
+    return response
 
 
+def replication_log_not_found():
+    return HttpResponseNotFound(json.dumps({"error": "not_found", "reason": "missing"}), content_type='application/json')
+
+
+@instrument_view
+@database_view
+@require_http_methods(['GET', 'PUT'])
+@csrf_exempt
+@cache_control(must_revalidate=True)
+def replication_log(request, db_name, replication_id):
+    if request.method == 'PUT':
+        body = json.loads(request.body.decode('utf-8'))
+        rep_log, last_history = save_replication_log(replication_id, body)
+        return get_replication_log_saved_response(rep_log, last_history)
+
+    return get_replication_log_response(request, list(get_replication_history(replication_id)))
+
+
+def get_changes_queryset(db_name, since, limit, document_types=None):
+    # the latest change of the documents changed after since: the log of the database is read from since and stops
+    # at limit, every change is checked against the newer ones of its document with the (document_type, document_key, id) index
+    newer_changes = Change.objects.filter(document_type=OuterRef('document_type'), document_key=OuterRef('document_key'), pk__gt=OuterRef('pk'))
+    if document_types is not None:
+        changes = Change.objects.for_document_types(set(document_types) & set(get_database_document_types(db_name)))
+    else:
+        changes = Change.objects.for_database(db_name)
+    return changes.filter(pk__gt=since).exclude(Exists(newer_changes)).select_related('document_type').order_by('pk')[:limit]
+
+
+def get_changes_document_types(request):
+    # filter=sofa/by_type&type=user&type=group (or type=user,group), the request of a PouchDB replication
+    # with filter: 'sofa/by_type' and query_params: {type: ...}. None when the feed isn't filtered by type
+    if request.GET.get('filter') != 'sofa/by_type':
+        return None
+    return [name for value in request.GET.getlist('type') for name in value.split(',') if name]
+
+
+def get_change_revisions_queryset(since, change):
+    return Change.objects.filter(pk__gt=since, document_type=change.document_type_id, document_key=change.document_key).values_list('revision', flat=True).order_by('pk')
+
+
+def get_change_row(change, revisions):
+    row = {
+        "seq": change.id, "id": change.document_id, "changes": [{"rev": f"1-{revision}"} for revision in revisions]
+    }
+    if change.deleted:
+        row["deleted"] = True
+    return row
+
+
+def add_changes_docs(request, results, changes):
+    # include_docs: the documents of the page are loaded by chunks with a query per document class, deleted ones are stubs
+    documents = [(change.document_id, get_document_info(change)) for change in changes]
+    contents = chain.from_iterable(iter_documents_chunks_content(request, documents, False))
+    for row, (_, content) in zip(results, contents):
+        row["doc"] = content
+
+
+def get_empty_changes_last_seq(db_name, since):
+    # a replica can be behind the primary: a later seq would make the client skip the changes still being replicated.
+    # The update_seq is cached and the replica lagging: neither may rewind a client already past them
+    read_database = get_read_database()
+    if read_database is not None and read_database.seq is not None:
+        return max(since, read_database.seq)
+    return max(since, get_update_seq(db_name).get_last_seq())
+
+
+@instrument_view
+@database_view
+@profile_view
+@admission_view
+@compress_view
+@replica_view
 @require_http_methods(['GET'])
 @cache_control(must_revalidate=True)
-def changes(request):
+def changes(request, db_name):
     style = request.GET.get('style')  # all_docs
     since = int(request.GET.get('since', '0'))
     limit = int(request.GET.get('limit', '1000'))  # TODO: make default max limit configurable
     feed = request.GET.get('feed', 'normal')  # (continuous, normal, longpoll)
-    # TODO: filter
+    include_docs = request.GET.get('include_docs') == 'true'
+    document_types = get_changes_document_types(request)
+    if document_types == []:
+        return HttpResponseBadRequest('{"error": "bad_request", "reason": "the sofa/by_type filter requires a type"}', content_type='application/json')
 
     results = []
 
     # TODO: stream
     last_change = 0
-    for change in Change.objects.filter(pk__gt=since).values('document_id').annotate(id=Max('pk'), deleted=Max('deleted')).order_by('id')[:limit]:
+    changes_page = []
+    for change in get_changes_queryset(db_name, since, limit, document_types):
         # TODO: instead of querying, use ArrayAgg for revisions if db is postgres
-        change_id = change['id']
-        revisions = Change.objects.filter(pk__gt=since, document_id=change['document_id']).annotate(rev=Concat(Value('1-'), Cast('revision', CharField()))).values('rev').order_by('pk')
-        row = {
-            "seq": change_id, "id": change['document_id'], "changes": revisions[::-1]
-        }
-        if change["deleted"] == 1:
-            row["deleted"] = True
-
-        results.append(row)
-        last_change = change_id
+        revisions = get_change_revisions_queryset(since, change)
+        results.append(get_change_row(change, revisions[::-1]))
+        changes_page.append(change)
+        last_change = change.id
+    if include_docs:
+        add_changes_docs(request, results, changes_page)
+    add_rows(len(results))
     if feed == 'normal':
+        last_seq = last_change if last_change > 0 else get_empty_changes_last_seq(db_name, since)
+        remember_client_seq(request, last_seq)
         return JsonResponse({
             "results": results,
-            "last_seq": str(last_change if last_change > 0 else Change.objects.latest('id').id)
+            "last_seq": str(last_seq)
         })
     else:
         return HttpResponseBadRequest('{"error": "sync style not implemented"}', content_type='application/json')
 
 
-@require_http_methods(['POST'])
-@csrf_exempt
-@cache_control(must_revalidate=True)
-def all_docs(request):
-    body = json.loads(request.body.decode('utf-8'))
-    keys = body.get('keys', [])
-    include_docs = request.GET.get('include_docs') == 'true'
+def get_all_docs_queryset(db_name, keys):
+    return Change.objects.get_latest_changes(filter_database_document_ids(db_name, keys))
+
 
-    docs_changes = Change.objects.filter(pk__in=Subquery(Change.objects.filter(document_id__in=keys).values('document_id').annotate(id=Max('pk')).values('id'))).all()
+def get_all_docs_rows(db_name, keys):
+    return [get_all_docs_row(d) for d in get_all_docs_queryset(db_name, keys)]
 
+
+def get_all_docs_row(change):
     # never returning the doc and forcing the rev to empty string is the only way I found to force bulk_get.
     # I also found sync gateway returning the rev as empty string
     # we need to change 1- ... is checked in pouchdb :(
+    return {
+        "id": change.document_id,
+        "key": change.document_id,
+        "value": {
+            "rev": ""  # f"1-{change.revision}"
+        },
+    }
+
+
+def get_all_docs_params(request):
+    def get_key(*names):
+        for name in names:
+            if name in request.GET:
+                return json.loads(request.GET[name])
+
+    limit = request.GET.get('limit')
+    return {
+        "startkey": get_key('startkey', 'start_key'),
+        "endkey": get_key('endkey', 'end_key'),
+        "descending": request.GET.get('descending') == 'true',
+        "inclusive_end": request.GET.get('inclusive_end') != 'false',
+        "skip": int(request.GET.get('skip', '0')),
+        "limit": int(limit) if limit is not None else None,
+    }
+
+
+def get_total_rows(db_name):
+    # counting the documents groups the whole log of the database: the count is cached with the last change it
+    # includes, and counted again once the database has changed
+    cache_key = f'sofa:total_rows:{db_name}'
+    cached = cache.get(cache_key)
+    if cached is not None and cached[0] >= get_update_seq(db_name).get_last_seq():
+        return cached[1]
+    # the last change of the database read (maybe a replica), not the update_seq: the count is right for that change
+    seq = Change.objects.get_last_id(db_name)
+    total_rows = Change.objects.count_documents(db_name, until=seq)
+    cache.set(cache_key, (seq, total_rows), None)
+    return total_rows
+
+
+def iter_all_docs(request, db_name, include_docs, skip=0, limit=None, **keys_range):
+    # deleted documents are not part of _all_docs
+    document_types = get_database_document_types(db_name)
+    latest_changes = (c for c in Change.objects.iter_latest_changes(document_types=document_types, **keys_range) if not c.deleted)
+    latest_changes = islice(latest_changes, skip, skip + limit if limit is not None else None)
+    documents = ((change.document_id, get_document_info(change)) for change in latest_changes)
+
+    if include_docs:
+        rows = ((doc_id, content["_rev"], content) for doc_id, content in iter_documents_content(request, documents, False))
+    else:
+        rows = ((doc_id, f"1-{document_info['rev']}", None) for doc_id, document_info in documents)
+
+    yield '{"rows": ['
+
+    first = True
+
+    for doc_id, rev, content in rows:
+
+        if not first:
+            yield ","
+
+        first = False
+
+        row = {"id": doc_id, "key": doc_id, "value": {"rev": rev}}
+        if content is not None:
+            row["doc"] = content
+        add_rows()
+
+        yield document_renderer.render(row).decode('utf-8')
+
+    yield f'], "total_rows": {get_total_rows(db_name)}, "offset": {skip}, "update_seq": {get_update_seq(db_name).get_last_seq()}}}'
 
-    rows = [
-        {
-            "id": d.document_id,
-            "key": d.document_id,
-            "value": {
-                "rev": "" # f"1-{d.revision}"
-            },
-            # "doc": Change(document_id=d.document_id, revision=d.revision).get_document(request) if include_docs else None
-        } for d in docs_changes
-    ]
+
+@instrument_view
+@database_view
+@profile_view
+@admission_view
+@compress_view
+@replica_view
+@require_http_methods(['GET', 'POST'])
+@csrf_exempt
+@cache_control(must_revalidate=True)
+def all_docs(request, db_name):
+    include_docs = request.GET.get('include_docs') == 'true'
+
+    if request.method == 'GET':
+        return StreamingHttpResponse(
+            streaming_content=iter_all_docs(request, db_name, include_docs, **get_all_docs_params(request)),
+            content_type='application/json',
+        )
+
+    body = json.loads(request.body.decode('utf-8'))
+    keys = body.get('keys', [])
+
+    rows = get_all_docs_rows(db_name, keys)
+    add_rows(len(rows))
 
     return JsonResponse({
         "rows": rows,
         "total_rows": len(rows),
-        "update_seq": Change.objects.latest('id').id
+        "update_seq": get_update_seq(db_name).get_last_seq()
     })
 
 
-def iter_documents(request, requested_docs, return_revisions):
+def get_document_info(change):
+    return {
+        "rev": str(change.revision),
+        "deleted": change.deleted,
+        "change": change
+    }
 
-    ids = {d['id'] for d in requested_docs['docs']}
 
-    latest_changes = Change.objects.get_latest_changes(ids)
+def get_document_result(document_id, content):
+    return f'{{"id": "{document_id}", "docs": [{{"ok": {document_renderer.render(content).decode("utf-8")}}}]}}'
 
-    docs_map = {}
 
-    for change in latest_changes:
-        docs_map[change.document_id] = {
-            "rev": str(change.revision),
-            "deleted": change.deleted == 1,
-            "revisions": Change.objects.get_revisions_for_document(change.document_id)
-        }
+def get_requested_documents(db_name, requested_docs):
+    # the documents of the other databases are missing, like unknown ones
+    ids = filter_database_document_ids(db_name, {d['id'] for d in requested_docs['docs']})
+    return [(change.document_id, get_document_info(change)) for change in Change.objects.get_latest_changes(ids)]
 
-    yield '{"results": ['
 
-    first = True
+def iter_documents(request, db_name, requested_docs, return_revisions):
 
-    for key, value in docs_map.items():
+    with phase('iter_documents.latest_changes'):
+        documents = get_requested_documents(db_name, requested_docs)
 
-        if not first:
-            yield ","
+    yield '{"results": ['
 
-        first = False
+    first = True
 
-        yield f'{{"id": "{key}", "docs": ['
+    for chunk_contents in iter_documents_chunks_content(request, documents, return_revisions):
+        for key, content in chunk_contents:
 
-        document_class = get_class_by_document_id(key)
+            if not first:
+                yield ","
 
-        if not value['deleted']:
-            content = document_class.get_document_content_as_json(key, value['rev'], value["revisions"] if return_revisions else [], request)
-            yield f'{{"ok": {content}}}'
+            first = False
 
-        else:
-            content = document_class.get_document_content_as_json(key, value['rev'], value["revisions"] if return_revisions else [], request, force_delete=True)
-            yield f'{{"ok": {content}}}'
+            add_rows()
+            with phase('iter_documents.render'):
+                result = get_document_result(key, content)
+            yield result
 
-        yield ']}'
+        # an empty chunk ends the documents loaded together, compressed streams are flushed there (see compress_view)
+        yield ''
 
     yield ']}'
 
 
-@require_http_methods(['POST'])
-@csrf_exempt
-@cache_control(must_revalidate=True)
-def bulk_get(request):
+def check_bulk_get_request(request):
     only_latest = request.GET.get('latest') == 'true'
 
     if not only_latest:
@@ -225,68 +457,133 @@ def bulk_get(request):
     if not request.accepts('application/json'):
         return HttpResponseBadRequest('Only application/json type is supported as response content')
 
+
+@instrument_view
+@database_view
+@profile_view
+@admission_view
+@compress_view
+@replica_view
+@require_http_methods(['POST'])
+@csrf_exempt
+@cache_control(must_revalidate=True)
+def bulk_get(request, db_name):
+    error_response = check_bulk_get_request(request)
+    if error_response:
+        return error_response
+
     return_revisions = request.GET.get('revs') == 'true'
     body = json.loads(request.body.decode('utf-8'))
 
     return StreamingHttpResponse(
-        streaming_content=(iter_documents(request, body, return_revisions)),
+        streaming_content=(iter_documents(request, db_name, body, return_revisions)),
         content_type='application/json',
     )
 
 
-@require_http_methods(['POST'])
-@csrf_exempt
-@cache_control(must_revalidate=True)
-def revs_diff(request):
-    # TODO: and existing deleted document?
-    changed_docs = json.loads(request.body.decode('utf-8'))
-
+def get_revs_diff_queryset(db_name, changed_docs):
     docs_filter = Q()
 
     for doc_id, revisions in changed_docs.items():
-        for revision in revisions:
-            docs_filter |= Q(document_id=doc_id, revision=revision.split('-')[1])
+        document_type, document_key = split_document_id(doc_id)
+        document_type = DocumentType.objects.get_for_name(document_type)
+        # unknown documents, documents of the other databases and malformed revisions can't be stored, so they are missing
+        revisions = [r.split('-')[-1] for r in revisions if is_revision(r.split('-')[-1])]
+        if document_type is not None and revisions and get_database_by_document_id(doc_id) == db_name:
+            docs_filter |= Q(document_type=document_type, document_key=document_key, revision__in=revisions)
+
+    return Change.objects.filter(docs_filter) if docs_filter else Change.objects.none()
 
-    existing_docs = Change.objects.filter(docs_filter)
 
+def get_missing_revisions(changed_docs, existing_docs):
     # clean existing doc from changed_docs
     for existing_doc in existing_docs:
-        changed_docs[existing_doc.document_id] = [i for i in changed_docs[existing_doc.document_id] if not i.endswith(f"-{existing_doc.revision}")]
+        changed_docs[existing_doc.document_id] = [i for i in changed_docs[existing_doc.document_id] if not i.lower().endswith(f"-{existing_doc.revision}")]
 
     # clean doc without revisions
-    changed_docs = {k: v for (k, v) in changed_docs.items() if v}
+    return {k: {"missing": v} for (k, v) in changed_docs.items() if v}
 
-    return JsonResponse({k: {"missing": v} for (k, v) in changed_docs.items()})
 
+def get_revs_diff(db_name, changed_docs):
+    return get_missing_revisions(changed_docs, get_revs_diff_queryset(db_name, changed_docs))
 
-def update_doc(request):
+
+@instrument_view
+@database_view
+@profile_view
+@admission_view
+@replica_view
+@require_http_methods(['POST'])
+@csrf_exempt
+@cache_control(must_revalidate=True)
+def revs_diff(request, db_name):
+    # TODO: and existing deleted document?
+    changed_docs = json.loads(request.body.decode('utf-8'))
+
+    missing = get_revs_diff(db_name, changed_docs)
+    add_rows(len(missing))
+    return JsonResponse(missing)
+
+
+def get_stored_revisions(db_name, docs):
+    # the (document id, revision) pairs of the pushed docs already in the change log, with a single query
+    pushed = {}
+    for doc in docs:
+        pushed.setdefault(doc['_id'], []).append(doc['_rev'])
+    return {(change.document_id, str(change.revision)) for change in get_revs_diff_queryset(db_name, pushed)}
+
+
+def update_doc(request, db_name):
     affected = []
     # TODO: the request body should be read as stream
-    body = json.loads(request.body.decode('utf-8'))
+    with phase('update_doc.parse'):
+        body = json.loads(request.body.decode('utf-8'))
 
     if body.get('new_edits', True):
         return HttpResponseBadRequest('Docs without revision are not supported')
 
+    # a push retried after a timeout sends the same revisions again: they are skipped, so they aren't saved
+    # and written to the log twice (every client would fetch them again)
+    with phase('update_doc.stored_revisions'):
+        stored_revisions = get_stored_revisions(db_name, body['docs'])
+
     for doc in body['docs']:
         doc_id = doc.pop('_id')
         rev_id = doc.pop('_rev')
 
         doc_class = get_class_by_document_id(doc_id)
-        if not doc_class:
-            # no related doc in django
+        if not doc_class or doc_class.get_database() != db_name:
+            # no related doc in django, or in this database
+            continue
+
+        revision = rev_id.split('-')[-1].lower()
+        if not is_revision(revision):
+            affected.append({"id": doc_id, "error": "bad_request", "reason": "Invalid rev format"})
             continue
 
-        res = doc_class.apply_changes(doc_id, rev_id, doc, request)
+        if (doc_id, revision) in stored_revisions:
+            documents_already_stored.inc(1, doc_class.Meta.document_id)
+            affected.append({"id": doc_id, "rev": rev_id})
+            continue
+
+        with phase(f'update_doc.apply_changes.{doc_class.__name__}'):
+            res = doc_class.apply_changes(doc_id, rev_id, doc, request)
         if res:
             affected.append(res)
+            stored_revisions.add((doc_id, revision))
 
+    add_rows(len(affected))
     return affected
 
 
+@instrument_view
+@database_view
+@profile_view
+@primary_write_view
 @require_http_methods(['GET', 'POST'])
 @csrf_exempt
 @cache_control(must_revalidate=True)
-def document(request, document_id):
+def document(request, db_name, document_id):
 
     if request.method == 'GET':
 
@@ -298,17 +595,103 @@ def document(request, document_id):
             # open_revs could not be ignored
             raise NotImplementedError
 
-        latest_changes = Change.objects.get_latest_changes(ids=[document_id])
-        return JsonResponse([latest_changes[0].get_document(request)], safe=False)
+        latest_change = Change.objects.get_latest_changes(ids=filter_database_document_ids(db_name, [document_id])).first()
+        if not latest_change:
+            return HttpResponseNotFound(json.dumps({"error": "not_found", "reason": "missing"}), content_type='application/json')
+
+        # the revision is enough to know if the client already has the document: skip the serialization
+        etag = f'"1-{latest_change.revision}"'
+        if etag in parse_etags(request.META.get('HTTP_IF_NONE_MATCH', '')):
+            response = HttpResponseNotModified()
+        else:
+            response = JsonResponse([latest_change.get_document(request)], safe=False)
+        response['ETag'] = etag
+        return response
 
     if request.method == 'POST':
-        affected = update_doc(request)
+        affected = update_doc(request, db_name)
         return JsonResponse(affected, safe=False)
 
 
+@instrument_view
+@database_view
+@profile_view
+@admission_view
+@primary_write_view
 @require_http_methods(['POST'])
 @csrf_exempt
 @cache_control(must_revalidate=True)
-def bulk_docs(request):
-    affected = update_doc(request)
+def bulk_docs(request, db_name):
+    affected = update_doc(request, db_name)
     return JsonResponse(affected, safe=False)
+
+
+def get_snapshot_range(request, size):
+    # a single "bytes=start-end" range, resumed downloads only. None for the whole file, False when not satisfiable
+    match = re.fullmatch(r'bytes=(\d*)-(\d*)', request.META.get('HTTP_RANGE', '').strip())
+    if not match or match[1] == match[2] == '':
+        return None
+    if match[1] == '':
+        start, end = max(size - int(match[2]), 0), size - 1
+    else:
+        start, end = int(match[1]), min(int(match[2]), size - 1) if match[2] else size - 1
+    if start > end:
+        return False
+    return start, end
+
+
+def iter_file_range(path, start, length, chunk_size=64 * 1024):
+    with open(path, 'rb') as f:
+        f.seek(start)
+        while length > 0:
+            chunk = f.read(min(chunk_size, length))
+            if not chunk:
+                return
+            length -= len(chunk)
+            yield chunk
+
+
+@instrument_view
+@database_view
+@admission_view
+@require_http_methods(['GET', 'HEAD'])
+@cache_control(must_revalidate=True)
+def snapshot(request, db_name):
+    """
+    The latest snapshot of the database built by sofa_snapshot: gzipped NDJSON, a header with the seq of the snapshot,
+    then a document per line. The client loads the documents, then replicates from _changes?since=<seq>.
+    Interrupted downloads are resumed with Range (and If-Range, the ETag of the snapshot).
+    """
+    seq, path = get_latest_snapshot(db_name)
+    if path is None:
+        return HttpResponseNotFound(json.dumps({"error": "not_found", "reason": "no snapshot"}), content_type='application/json')
+
+    size = os.path.getsize(path)
+    etag = f'"{db_name}-{seq}"'
+    byte_range = get_snapshot_range(request, size)
+    if byte_range is not None and request.META.get('HTTP_IF_RANGE', etag) != etag:
+        # the snapshot changed since the start of the download: the whole new one is sent
+        byte_range = None
+
+    if byte_range is False:
+        response = HttpResponse(status=416)
+        response['Content-Range'] = f"bytes */{size}"
+    elif byte_range is not None:
+        start, end = byte_range
+        response = StreamingHttpResponse(iter_file_range(path, start, end - start + 1), status=206, content_type='application/gzip')
+        response['Content-Range'] = f"bytes {start}-{end}/{size}"
+        response['Content-Length'] = end - start + 1
+    else:
+        response = FileResponse(open(path, 'rb'), content_type='application/gzip')
+    response['Accept-Ranges'] = 'bytes'
+    response['ETag'] = etag
+    response['X-Sofa-Snapshot-Seq'] = seq
+    return response
+
+
+@require_http_methods(['GET'])
+def metrics(request):
+    if not getattr(settings, 'SOFA_METRICS_ENDPOINT', False):
+        return HttpResponseNotFound()
+    exporter = get_exporter()
+    return HttpResponse(exporter.export(registry), content_type=exporter.content_type)
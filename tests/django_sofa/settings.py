@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/3.2/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -83,9 +84,22 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        # a server and sofa_loadtest --url write the same file: wait for the lock instead of failing
+        'OPTIONS': {'timeout': 60},
     }
 }
 
+# SOFA_TEST_DATABASE=postgresql runs the project (tests and benchmarks) on the postgres service of docker-compose.yaml
+if os.environ.get('SOFA_TEST_DATABASE') == 'postgresql':
+    DATABASES['default'] = {
+        'ENGINE': 'django.db.backends.postgresql',
+        'NAME': os.environ.get('POSTGRES_DB', 'django_sofa'),
+        'USER': os.environ.get('POSTGRES_USER', 'django_sofa'),
+        'PASSWORD': os.environ.get('POSTGRES_PASSWORD', 'django_sofa'),
+        'HOST': os.environ.get('POSTGRES_HOST', 'localhost'),
+        'PORT': os.environ.get('POSTGRES_PORT', '5432'),
+    }
+
 
 # Password validation
 # https://docs.djangoproject.com/en/3.2/ref/settings/#auth-password-validators
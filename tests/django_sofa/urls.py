@@ -18,5 +18,7 @@ from django.urls import path, include
 
 urlpatterns = [
     path('admin/', admin.site.urls),
-    path('sofa/', include('sofa.urls'))
+    path('sofa/', include('sofa.urls')),
+    # the same endpoints with the async views, to compare them under an ASGI server
+    path('asofa/', include('sofa.async_urls')),
 ]
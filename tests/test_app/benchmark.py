@@ -0,0 +1,231 @@
+import json
+import statistics
+import time
+import tracemalloc
+from secrets import token_hex
+
+from asgiref.sync import async_to_sync
+from django.contrib.auth.models import User, Group
+from django.db import connection, reset_queries
+from django.test import Client, override_settings
+from django.test.utils import CaptureQueriesContext
+
+from sofa.models import Change, ReplicationLog
+
+from .documents import UserDocument, GroupsDocument
+
+
+SEED_BATCH_SIZE = 5000
+
+
+def get_username(index):
+    return f"user{index:08d}"
+
+
+def get_user_document_id(index):
+    return f"{UserDocument.Meta.document_id}:{get_username(index)}"
+
+
+def clear_dataset():
+    Change.objects.all().delete()
+    ReplicationLog.objects.all().delete()
+    User.objects.all().delete()
+    Group.objects.all().delete()
+
+
+def seed_dataset(size, revisions_every=10, groups=100):
+    """
+    Create `size` users, each with one change, plus 2 more revisions every `revisions_every` users,
+    and the GroupsDocument (or its shards) built on `groups` groups.
+    bulk_create skips the model signals, so the change log is written here.
+    """
+    clear_dataset()
+
+    Group.objects.bulk_create([Group(name=f"group{i:04d}") for i in range(groups)])
+
+    for start in range(0, size, SEED_BATCH_SIZE):
+        stop = min(start + SEED_BATCH_SIZE, size)
+        User.objects.bulk_create([User(username=get_username(i), email=f"{get_username(i)}@example.com") for i in range(start, stop)])
+
+        changes = []
+        for i in range(start, stop):
+            revisions = 3 if i % revisions_every == 0 else 1
+            changes += [Change(document_id=get_user_document_id(i), revision=token_hex(16)) for _ in range(revisions)]
+        Change.objects.bulk_create(changes)
+
+    GroupsDocument.add_revision()
+
+
+def get_latest_revisions(doc_ids):
+    return {c.document_id: c.revision for c in Change.objects.get_latest_changes(doc_ids)}
+
+
+async def read_async_content(response):
+    return b''.join([chunk async for chunk in response.streaming_content])
+
+
+def read_response(response):
+    if response.status_code >= 400:
+        raise AssertionError(f"{response.status_code} response: {response}")
+    if response.streaming and response.is_async:
+        return async_to_sync(read_async_content)(response)
+    if response.streaming:
+        return b''.join(response.streaming_content)
+    return response.content
+
+
+class Scenario:
+    def __init__(self, endpoint, name, request, settings=None):
+        # request is a callable (client) -> response, called again at every run, with the settings overridden
+        self.endpoint = endpoint
+        self.name = name
+        self.request = request
+        self.settings = settings or {}
+
+
+def get_scenarios(size, sample=100):
+    step = max(size // sample, 1)
+    sample_ids = [get_user_document_id(i) for i in range(0, size, step)][:sample]
+    # enough chunks of documents to keep a thread pool busy
+    bulk_get_ids = [get_user_document_id(i) for i in range(0, size, max(size // 1000, 1))][:1000]
+    latest_revisions = get_latest_revisions(sample_ids)
+    last_seq = Change.objects.latest('id').id
+
+    def post_json(path, body):
+        return lambda client: client.post(path, json.dumps(body), content_type='application/json', HTTP_ACCEPT='application/json')
+
+    def revs_diff_body():
+        # half of the revisions are already known, half are new
+        return {
+            doc_id: [f"1-{latest_revisions[doc_id]}" if n % 2 else f"2-{token_hex(16)}"]
+            for n, doc_id in enumerate(sample_ids)
+        }
+
+    def bulk_docs(client):
+        docs = [{"_id": doc_id, "_rev": f"2-{token_hex(16)}", "first_name": "bench"} for doc_id in sample_ids]
+        return client.post('/sofa/db/_bulk_docs', json.dumps({"docs": docs, "new_edits": False}), content_type='application/json')
+
+    # the same push every time: after the warm up, every request is a retry of stored revisions
+    retried_docs = [{"_id": doc_id, "_rev": f"2-{token_hex(16)}", "first_name": "retry"} for doc_id in sample_ids]
+
+    def replication_log(client):
+        client.put('/sofa/db/_local/benchmark', json.dumps({
+            "version": 1, "replicator": "benchmark", "session_id": token_hex(8), "last_seq": last_seq
+        }), content_type='application/json')
+        return client.get('/sofa/db/_local/benchmark')
+
+    return [
+        Scenario('changes', 'since=0&limit=1000', lambda client: client.get('/sofa/db/_changes?since=0&limit=1000')),
+        Scenario('changes', 'tail limit=1000', lambda client: client.get(f'/sofa/db/_changes?since={max(last_seq - 1000, 0)}&limit=1000')),
+        Scenario('bulk_get', f'{len(sample_ids)} docs', post_json('/sofa/db/_bulk_get?latest=true&revs=true', {"docs": [{"id": i} for i in sample_ids]})),
+        Scenario('bulk_get', f'{len(bulk_get_ids)} docs', post_json('/sofa/db/_bulk_get?latest=true&revs=true', {"docs": [{"id": i} for i in bulk_get_ids]})),
+        Scenario('bulk_get', f'{len(bulk_get_ids)} docs, 4 workers', post_json('/sofa/db/_bulk_get?latest=true&revs=true', {"docs": [{"id": i} for i in bulk_get_ids]}), {"SOFA_BULK_GET_WORKERS": 4}),
+        Scenario('revs_diff', f'{len(sample_ids)} docs', post_json('/sofa/db/_revs_diff', revs_diff_body())),
+        Scenario('all_docs', 'GET limit=1000', lambda client: client.get('/sofa/db/_all_docs?limit=1000')),
+        Scenario('all_docs', 'GET limit=100 include_docs', lambda client: client.get('/sofa/db/_all_docs?limit=100&include_docs=true')),
+        Scenario('all_docs', f'POST {len(sample_ids)} keys', post_json('/sofa/db/_all_docs', {"keys": sample_ids})),
+        Scenario('bulk_docs', f'{len(sample_ids)} docs', bulk_docs),
+        Scenario('bulk_docs', f'{len(sample_ids)} docs, retried', post_json('/sofa/db/_bulk_docs', {"docs": retried_docs, "new_edits": False})),
+        Scenario('replication_log', 'PUT + GET', replication_log),
+    ]
+
+
+# plan lines of a full scan of the change log
+FULL_SCAN_MARKERS = {
+    'sqlite': 'SCAN sofa_change',
+    'postgresql': 'Seq Scan on sofa_change',
+}
+
+
+class PlanCollector:
+    # execute wrapper keeping the parameters of the first run of every distinct select on the sofa tables
+    def __init__(self):
+        self.queries = {}
+
+    def __call__(self, execute, sql, params, many, context):
+        if sql.lstrip().upper().startswith('SELECT') and '"sofa_' in sql:
+            self.queries.setdefault(sql, params)
+        return execute(sql, params, many, context)
+
+
+def explain(sql, params):
+    with connection.cursor() as cursor:
+        cursor.execute(f"{connection.ops.explain_query_prefix()} {sql}", params)
+        rows = cursor.fetchall()
+    # sqlite returns (id, parent, notused, detail) rows
+    return [row[-1] if connection.vendor == 'sqlite' else " ".join(str(c) for c in row) for row in rows]
+
+
+def get_plans(scenario, client):
+    collector = PlanCollector()
+    with connection.execute_wrapper(collector):
+        read_response(scenario.request(client))
+
+    plans = []
+    for sql, params in collector.queries.items():
+        plan = explain(sql, params)
+        marker = FULL_SCAN_MARKERS.get(connection.vendor)
+        plans.append({"sql": sql, "plan": plan, "full_scan": bool(marker) and any(marker in line for line in plan)})
+    return plans
+
+
+def measure(scenario, client, repeat):
+    with override_settings(**scenario.settings):
+        return measure_requests(scenario, client, repeat)
+
+
+def measure_requests(scenario, client, repeat):
+    read_response(scenario.request(client))  # warm up
+
+    latencies = []
+    response_bytes = 0
+    for _ in range(repeat):
+        start = time.perf_counter()
+        response_bytes = len(read_response(scenario.request(client)))
+        latencies.append((time.perf_counter() - start) * 1000)
+
+    reset_queries()
+    with CaptureQueriesContext(connection) as queries:
+        read_response(scenario.request(client))
+    # captured_queries is read from the connection log, which is reset by the next request
+    queries_count = len(queries)
+
+    tracemalloc.start()
+    try:
+        read_response(scenario.request(client))
+        _, peak_memory = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    latencies.sort()
+    return {
+        "endpoint": scenario.endpoint,
+        "scenario": scenario.name,
+        "latency_ms": {
+            "min": round(latencies[0], 3),
+            "median": round(statistics.median(latencies), 3),
+            "p95": round(latencies[min(int(len(latencies) * 0.95), len(latencies) - 1)], 3),
+        },
+        "queries": queries_count,
+        "peak_memory_kb": round(peak_memory / 1024, 1),
+        "response_bytes": response_bytes,
+    }
+
+
+def run_benchmark(size, repeat, endpoints=None, plans=False):
+    seed_start = time.perf_counter()
+    seed_dataset(size)
+    seed_time = time.perf_counter() - seed_start
+
+    client = Client()
+    results = []
+    for scenario in get_scenarios(size):
+        if endpoints and scenario.endpoint not in endpoints:
+            continue
+        result = measure(scenario, client, repeat)
+        result.update({"size": size, "vendor": connection.vendor})
+        if plans:
+            result["plans"] = get_plans(scenario, client)
+        results.append(result)
+
+    return {"size": size, "vendor": connection.vendor, "changes": Change.objects.count(), "seed_seconds": round(seed_time, 1), "results": results}
@@ -18,6 +18,7 @@ class UserDocument(DocumentBase):
         replica_field = 'username'
         document_id = 'user'
         exclude = ('password',)
+        prefetch_related = ('groups', 'user_permissions')
 
 
 class GroupsDocument(DocumentBase):
@@ -0,0 +1,277 @@
+import json
+import random
+import statistics
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import Counter
+from secrets import token_hex
+
+from django.contrib.auth.models import User
+from django.db import connection, connections
+from django.test import Client
+
+from sofa.models import Change
+
+from .benchmark import get_user_document_id, get_username
+
+
+class QueryCounter:
+    # execute_wrapper shared by all the threads of the in-process server
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.queries = 0
+        self.time = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                self.queries += 1
+                self.time += elapsed
+
+
+class ClientTransport:
+    # requests served in-process by django, in the calling thread
+    def __init__(self, prefix, query_counter):
+        # server errors are counted as responses, not raised in the device thread
+        self.client = Client(raise_request_exception=False)
+        self.prefix = prefix
+        self.query_counter = query_counter
+
+    def request(self, method, path, body=None):
+        kwargs = {'HTTP_ACCEPT': 'application/json'}
+        if body is not None:
+            kwargs.update(data=json.dumps(body), content_type='application/json')
+        with connection.execute_wrapper(self.query_counter):
+            response = getattr(self.client, method.lower())(self.prefix + path, **kwargs)
+            content = b''.join(response.streaming_content) if response.streaming else response.content
+        return response.status_code, content
+
+    def close(self):
+        connections.close_all()
+
+
+class HttpTransport:
+    # requests sent to a running server
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip('/') + '/'
+
+    def request(self, method, path, body=None):
+        data = json.dumps(body).encode() if body is not None else None
+        request = urllib.request.Request(self.base_url + path, data=data, method=method, headers={
+            'Accept': 'application/json', 'Content-Type': 'application/json'
+        })
+        try:
+            with urllib.request.urlopen(request, timeout=60) as response:
+                return response.status, response.read()
+        except urllib.error.HTTPError as error:
+            return error.code, error.read()
+
+    def close(self):
+        pass
+
+
+class Device:
+    """
+    Replicates like PouchDB: a pull replication (database -> _local -> _changes -> _bulk_get -> _local PUT, the revs diff
+    of a pull is computed against the local docs) and, now and then, a push of an edit of its own user
+    (_revs_diff -> _bulk_docs -> _local PUT).
+    """
+
+    def __init__(self, index, transport, batch_size, push_probability, poll_interval):
+        self.index = index
+        self.transport = transport
+        self.batch_size = batch_size
+        self.push_probability = push_probability
+        self.poll_interval = poll_interval
+        self.replication_id = f"loadtest-{index}-{token_hex(4)}"
+        self.session_id = token_hex(8)
+        self.docs = {}
+        self.last_seq = 0
+        self.requests = Counter()
+        self.bytes = 0
+        self.errors = Counter()
+        self.converged_at = None
+
+    def call(self, method, path, body=None, endpoint=None):
+        status, content = self.transport.request(method, path, body)
+        self.requests[endpoint or path] += 1
+        self.bytes += len(content)
+        if status >= 400 and status != 404:
+            self.errors[f"{endpoint or path} {status}"] += 1
+            return status, None
+        return status, json.loads(content) if content else None
+
+    def checkpoint(self, replication_id, last_seq):
+        self.call('PUT', f'db/_local/{replication_id}', {
+            "version": 1, "replicator": "loadtest", "session_id": self.session_id, "last_seq": last_seq
+        }, endpoint='_local PUT')
+
+    def pull(self):
+        self.call('GET', 'db/', endpoint='database')
+        status, log = self.call('GET', f'db/_local/{self.replication_id}', endpoint='_local GET')
+        if status == 200 and log:
+            self.last_seq = int(log['last_seq'])
+
+        _, changes = self.call('GET', f'db/_changes?style=all_docs&since={self.last_seq}&limit={self.batch_size}', endpoint='_changes')
+        if not changes or not changes['results']:
+            return False
+
+        missing = [row['id'] for row in changes['results'] if self.docs.get(row['id']) != row['changes'][0]['rev']]
+        if missing:
+            _, docs = self.call('POST', 'db/_bulk_get?revs=true&latest=true', {"docs": [{"id": doc_id} for doc_id in missing]}, endpoint='_bulk_get')
+            for result in (docs or {}).get('results', []):
+                for doc in result['docs']:
+                    if 'ok' in doc:
+                        self.docs[result['id']] = doc['ok'].get('_rev')
+
+        self.last_seq = int(changes['last_seq'])
+        self.checkpoint(self.replication_id, self.last_seq)
+        return True
+
+    def push(self):
+        doc_id = get_user_document_id(self.index)
+        rev = f"2-{token_hex(16)}"
+        _, missing = self.call('POST', 'db/_revs_diff', {doc_id: [rev]}, endpoint='_revs_diff')
+        if missing:
+            self.call('POST', 'db/_bulk_docs', {"docs": [{"_id": doc_id, "_rev": rev, "first_name": f"device {self.index}"}], "new_edits": False}, endpoint='_bulk_docs')
+        self.checkpoint(f"{self.replication_id}-push", self.last_seq)
+
+    def run(self, state):
+        try:
+            while not state.stopped():
+                if self.push_probability and random.random() < self.push_probability:
+                    self.push()
+
+                received = self.pull()
+
+                target_seq = state.target_seq
+                if target_seq is not None and self.last_seq >= target_seq:
+                    self.converged_at = time.perf_counter()
+                    return
+
+                if not received:
+                    time.sleep(self.poll_interval)
+        finally:
+            self.transport.close()
+
+
+class Writer:
+    # server-side writes: users saved at a fixed rate, through the model signals like any django code
+    def __init__(self, rate, duration, users):
+        self.rate = rate
+        self.duration = duration
+        self.users = users
+        self.writes = 0
+
+    def run(self):
+        try:
+            if not self.rate:
+                return
+            interval = 1.0 / self.rate
+            end = time.perf_counter() + self.duration
+            next_write = time.perf_counter()
+            while time.perf_counter() < end:
+                user = User.objects.get(username=get_username(random.randrange(self.users)))
+                user.last_name = token_hex(4)
+                user.save()
+                self.writes += 1
+                next_write += interval
+                time.sleep(max(next_write - time.perf_counter(), 0))
+        finally:
+            connections.close_all()
+
+
+class LoadState:
+    def __init__(self, timeout):
+        self.deadline = time.perf_counter() + timeout
+        self.target_seq = None
+
+    def stopped(self):
+        return time.perf_counter() > self.deadline
+
+
+def get_postgresql_stats():
+    if connection.vendor != 'postgresql':
+        return None
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT xact_commit, tup_returned, tup_fetched, tup_inserted, tup_updated, blks_read, blks_hit "
+            "FROM pg_stat_database WHERE datname = current_database()"
+        )
+        return dict(zip(['xact_commit', 'tup_returned', 'tup_fetched', 'tup_inserted', 'tup_updated', 'blks_read', 'blks_hit'], cursor.fetchone()))
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(int(len(values) * p), len(values) - 1)] if values else None
+
+
+def run_loadtest(devices, users, write_rate, duration, batch_size, push_probability, poll_interval, timeout, base_url=None):
+    query_counter = QueryCounter()
+
+    def get_transport():
+        if base_url:
+            return HttpTransport(base_url)
+        return ClientTransport('/sofa/', query_counter)
+
+    db_stats_before = get_postgresql_stats()
+    state = LoadState(timeout)
+    writer = Writer(write_rate, duration, users)
+    clients = [Device(i % users, get_transport(), batch_size, push_probability, poll_interval) for i in range(devices)]
+
+    start = time.perf_counter()
+    writer_thread = threading.Thread(target=writer.run)
+    device_threads = [threading.Thread(target=device.run, args=(state,)) for device in clients]
+    writer_thread.start()
+    for thread in device_threads:
+        thread.start()
+
+    # devices have converged when they reach the last change written by the server and by the devices
+    writer_thread.join()
+    writes_end = time.perf_counter()
+    state.target_seq = Change.objects.latest('id').id
+    for thread in device_threads:
+        thread.join()
+    end = time.perf_counter()
+
+    db_stats_after = get_postgresql_stats()
+    converged = [d for d in clients if d.converged_at]
+    converge_times = [d.converged_at - writes_end for d in converged]
+    requests = [sum(d.requests.values()) for d in clients]
+    by_endpoint = Counter()
+    for device in clients:
+        by_endpoint.update(device.requests)
+
+    return {
+        "devices": devices,
+        "users": users,
+        "write_rate": write_rate,
+        "duration": duration,
+        "server_writes": writer.writes,
+        "target_seq": state.target_seq,
+        "elapsed_seconds": round(end - start, 3),
+        "converged_devices": len(converged),
+        "time_to_converge_seconds": {
+            "median": round(statistics.median(converge_times), 3) if converge_times else None,
+            "p95": round(percentile(converge_times, 0.95), 3) if converge_times else None,
+            "max": round(max(converge_times), 3) if converge_times else None,
+        },
+        "requests_per_device": {
+            "median": statistics.median(requests),
+            "max": max(requests),
+        },
+        "requests_by_endpoint": dict(by_endpoint),
+        "bytes_received": sum(d.bytes for d in clients),
+        "errors": dict(sum((d.errors for d in clients), Counter())),
+        "db": {
+            "queries": query_counter.queries if not base_url else None,
+            "query_seconds": round(query_counter.time, 3) if not base_url else None,
+            "postgresql": {k: db_stats_after[k] - db_stats_before[k] for k in db_stats_after} if db_stats_before else None,
+        },
+    }
@@ -0,0 +1,58 @@
+import json
+import platform
+import sys
+
+import django
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import setup_test_environment, teardown_test_environment
+
+from test_app.benchmark import run_benchmark
+
+
+class Command(BaseCommand):
+    help = 'Seed synthetic datasets in a throwaway database and measure latency, queries and memory of the sofa endpoints'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', nargs='+', type=int, default=[10000, 100000, 1000000])
+        parser.add_argument('--repeat', type=int, default=10)
+        parser.add_argument('--endpoint', action='append', dest='endpoints', help='Limit to the given endpoint (repeatable)')
+        parser.add_argument('--output', help='Write the JSON report to this file instead of stdout')
+        parser.add_argument('--keepdb', action='store_true', help='Keep the benchmark database at the end')
+        parser.add_argument('--explain', action='store_true', help='Add the query plans of every endpoint to the report')
+
+    def handle(self, *args, **options):
+        # same environment and throwaway database used by the test runner, the configured database is never touched.
+        # DEBUG is turned off, or every query would be logged and slow down every request.
+        setup_test_environment(debug=False)
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True, keepdb=options['keepdb'])
+
+        try:
+            runs = []
+            for size in options['sizes']:
+                self.stderr.write(f'{connection.vendor}: seeding and measuring {size} documents...')
+                run = run_benchmark(size, options['repeat'], options['endpoints'], options['explain'])
+                for result in run['results']:
+                    self.stderr.write('  {endpoint:<16} {scenario:<28} {latency_ms[median]:>10.2f} ms {queries:>6} queries {peak_memory_kb:>10.1f} KB'.format(**result))
+                    for plan in result.get('plans', []):
+                        if plan['full_scan']:
+                            self.stderr.write(f"    full scan: {plan['sql'][:120]}")
+                runs.append(run)
+        finally:
+            if not options['keepdb']:
+                connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+        report = json.dumps({
+            "python": platform.python_version(),
+            "django": django.get_version(),
+            "vendor": connection.vendor,
+            "runs": runs,
+        }, indent=2)
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(report)
+        else:
+            sys.stdout.write(report + '\n')
@@ -0,0 +1,72 @@
+import json
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import setup_test_environment, teardown_test_environment
+
+from test_app.benchmark import seed_dataset
+from test_app.loadtest import run_loadtest
+
+
+class Command(BaseCommand):
+    help = 'Simulate many PouchDB-like devices replicating concurrently while the server keeps writing'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--devices', type=int, default=200)
+        parser.add_argument('--users', type=int, default=10000, help='Size of the seeded dataset')
+        parser.add_argument('--write-rate', type=float, default=20, help='Server-side writes per second')
+        parser.add_argument('--duration', type=float, default=30, help='Seconds of server-side writes')
+        parser.add_argument('--batch-size', type=int, default=100, help='_changes limit, like PouchDB batch_size')
+        parser.add_argument('--push-probability', type=float, default=0.1, help='Probability of a device push at every cycle')
+        parser.add_argument('--poll-interval', type=float, default=1, help='Seconds a device waits when it is up to date')
+        parser.add_argument('--timeout', type=float, default=600)
+        parser.add_argument('--url', help='Base url of a running server (e.g. http://localhost:8000/sofa/). '
+                                          'The server and this command must use the same database: it is seeded and written here, '
+                                          'which deletes its users, groups and change log (see --reset-database).')
+        parser.add_argument('--reset-database', action='store_true',
+                            help='Required with --url: confirm that the users, groups, change log and replication logs '
+                                 'of the server database are deleted and replaced by the seeded dataset')
+        parser.add_argument('--output', help='Write the JSON report to this file instead of stdout')
+
+    def handle(self, *args, **options):
+        in_process = not options['url']
+        if not in_process and not options['reset_database']:
+            raise CommandError('--url seeds the database of the server, deleting its users, groups, change log and '
+                               'replication logs: add --reset-database to confirm')
+        if in_process:
+            setup_test_environment(debug=False)
+            # the devices run in threads, each one with its own connection: sqlite needs a file to share the database,
+            # and a longer busy timeout as writes are serialized
+            if connection.vendor == 'sqlite':
+                connection.settings_dict['TEST']['NAME'] = 'sofa_loadtest.sqlite3'
+                connection.settings_dict['OPTIONS'].setdefault('timeout', 60)
+            old_name = connection.settings_dict['NAME']
+            connection.creation.create_test_db(verbosity=0, autoclobber=True)
+
+        try:
+            self.stderr.write(f"seeding {options['users']} users...")
+            seed_dataset(options['users'])
+            self.stderr.write(f"running {options['devices']} devices...")
+            report = run_loadtest(
+                devices=options['devices'],
+                users=options['users'],
+                write_rate=options['write_rate'],
+                duration=options['duration'],
+                batch_size=options['batch_size'],
+                push_probability=options['push_probability'],
+                poll_interval=options['poll_interval'],
+                timeout=options['timeout'],
+                base_url=options['url'],
+            )
+        finally:
+            if in_process:
+                connection.creation.destroy_test_db(old_name, verbosity=0)
+                teardown_test_environment()
+
+        report = json.dumps(dict(report, vendor=connection.vendor, in_process=in_process), indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(report)
+        else:
+            sys.stdout.write(report + '\n')
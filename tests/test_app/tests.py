@@ -1,3 +1,521 @@
-from django.test import TestCase
+import gzip
+import hashlib
+import io
+import json
+import tempfile
+import zlib
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from django.contrib.auth.models import User, Group
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.db import connection
+from django.db.migrations.executor import MigrationExecutor
+from django.test import TestCase, TransactionTestCase, override_settings
+
+from sofa import loader
+from sofa.models import Change, DocumentType, ReplicationHistory, ReplicationLog
+from sofa.sequence import get_update_seq
+
+# the test runner imports this module from the tests package, the document classes are the ones loaded from test_app
+from test_app.benchmark import PlanCollector, explain, get_plans, get_scenarios, get_user_document_id, read_response, seed_dataset, FULL_SCAN_MARKERS
+from test_app.documents import UserDocument, GroupsDocument
+
+
+# the sync views (sofa.urls) and the async ones (sofa.async_urls) answer the same
+PREFIXES = ('sofa', 'asofa')
+
+
+async def collect_async_chunks(response):
+    return [chunk async for chunk in response.streaming_content]
+
+
+def read_chunks(response):
+    if response.is_async:
+        return async_to_sync(collect_async_chunks)(response)
+    return list(response.streaming_content)
+
+
+class SofaTestCase(TestCase):
+    # the document types, update_seq and total_rows are cached in memory and outlive the rollback of a test
+
+    def setUp(self):
+        cache.clear()
+        DocumentType.objects.clear_cache()
+        for db_name in loader.get_databases():
+            get_update_seq(db_name).clear()
+
+    def get_json(self, response):
+        return json.loads(read_response(response))
+
+    def post_json(self, path, body, **extra):
+        return self.client.post(path, json.dumps(body), content_type='application/json', HTTP_ACCEPT='application/json', **extra)
+
+
+class ChangeLogPlansTest(TestCase):
+    """
+    The replication endpoints and the ChangeManager queries must use the indexes of the change log: a full scan of
+    sofa_change is a plan regression.
+    """
+    size = 2000
+
+    @classmethod
+    def setUpTestData(cls):
+        seed_dataset(cls.size)
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+
+    def setUp(self):
+        cache.clear()
+
+    def assertNoFullScan(self, plans):
+        full_scans = [plan for plan in plans if plan["full_scan"]]
+        self.assertEqual(full_scans, [])
+
+    def get_collected_plans(self, run):
+        collector = PlanCollector()
+        with connection.execute_wrapper(collector):
+            run()
+        marker = FULL_SCAN_MARKERS[connection.vendor]
+        plans = []
+        for sql, params in collector.queries.items():
+            plan = explain(sql, params)
+            plans.append({"sql": sql, "plan": plan, "full_scan": any(marker in line for line in plan)})
+        return plans
+
+    def test_endpoints(self):
+        for scenario in get_scenarios(self.size):
+            if scenario.endpoint not in ('changes', 'all_docs', 'revs_diff'):
+                continue
+            with self.subTest(endpoint=scenario.endpoint, scenario=scenario.name):
+                # total_rows counts every document of the database once, then it is cached until the next change
+                read_response(scenario.request(self.client))
+                self.assertNoFullScan(get_plans(scenario, self.client))
+
+    def test_change_manager(self):
+        doc_id = get_user_document_id(0)
+        change = Change.objects.get_latest_changes([doc_id]).get()
+        queries = {
+            'get_latest_changes': lambda: list(Change.objects.get_latest_changes([doc_id, get_user_document_id(1)])),
+            'iter_latest_changes': lambda: list(Change.objects.iter_latest_changes(startkey=doc_id, chunk_size=10)),
+            'for_document_types': lambda: list(Change.objects.for_document_types(['user']).order_by('pk')[:10]),
+            'get_superseded_changes': lambda: list(Change.objects.get_superseded_changes(1).filter(document_type=change.document_type_id)),
+            'get_revisions_for_document': lambda: list(Change.objects.get_revisions_for_document(doc_id)),
+            'get_revisions_for_change': lambda: list(Change.objects.get_revisions_for_change(change, 10)),
+        }
+        for name, run in queries.items():
+            with self.subTest(query=name):
+                self.assertNoFullScan(self.get_collected_plans(run))
+
+
+class DocumentQueriesTest(SofaTestCase):
+    """
+    The documents of _all_docs?include_docs=true and _bulk_get are loaded with a query per document class and chunk, their
+    many to many fields with a query per relation (Meta.prefetch_related), whatever the number of documents.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        seed_dataset(200)
+
+    def test_all_docs_include_docs(self):
+        url = '/sofa/db/_all_docs?limit=100&include_docs=true'
+        # caches the document types and total_rows
+        with self.captureOnCommitCallbacks(execute=True):
+            read_response(self.client.get(url))
+        # the latest changes of each document type and page, the users with their groups and permissions, the groups
+        with self.assertNumQueries(10):
+            read_response(self.client.get(url))
+
+    def test_bulk_get(self):
+        body = json.dumps({"docs": [{"id": get_user_document_id(i)} for i in range(100)]})
+        request = lambda: self.client.post('/sofa/db/_bulk_get?latest=true', body, content_type='application/json', HTTP_ACCEPT='application/json')
+        # caches the document types
+        with self.captureOnCommitCallbacks(execute=True):
+            read_response(request())
+        # the latest changes, the users with their groups and permissions
+        with self.assertNumQueries(4):
+            read_response(request())
+
+
+class CompactChangeMigrationTest(TransactionTestCase):
+    """
+    0008 to 0010 split the document ids of the change log in (document type, key) and store the revisions in 16 bytes,
+    and back.
+    """
+    before = [('sofa', '0007_auto_20211020_1538')]
+    after = [('sofa', '0010_compact_change_cleanup')]
+
+    def migrate(self, targets):
+        executor = MigrationExecutor(connection)
+        executor.migrate(targets)
+        return executor.loader.project_state(targets).apps
+
+    def tearDown(self):
+        executor = MigrationExecutor(connection)
+        executor.migrate(executor.loader.graph.leaf_nodes())
+        DocumentType.objects.clear_cache()
+
+    def test_forwards_backwards(self):
+        Change = self.migrate(self.before).get_model('sofa', 'Change')
+        Change.objects.create(document_id='user:alice', revision='AB' * 16, deleted=0)
+        Change.objects.create(document_id='user:a:b', revision='cd' * 16, deleted=1)
+        Change.objects.create(document_id='groups', revision='not-a-revision', deleted=0)
+        # a revision that isn't 32 hex chars is replaced by its md5, for good: clients fetch the document again
+        replaced = hashlib.md5(b'not-a-revision').hexdigest()
+
+        Change = self.migrate(self.after).get_model('sofa', 'Change')
+        self.assertEqual(list(Change.objects.order_by('pk').values_list('document_type__name', 'document_key', 'revision', 'deleted')), [
+            ('user', 'alice', 'ab' * 16, False),
+            ('user', 'a:b', 'cd' * 16, True),
+            ('groups', '', replaced, False),
+        ])
+
+        Change = self.migrate(self.before).get_model('sofa', 'Change')
+        self.assertEqual(list(Change.objects.order_by('pk').values_list('document_id', 'revision', 'deleted')), [
+            ('user:alice', 'ab' * 16, 0),
+            ('user:a:b', 'cd' * 16, 1),
+            ('groups', replaced, 0),
+        ])
+
+
+class RevisionFieldTest(SofaTestCase):
+    def test_round_trip(self):
+        change = Change.objects.create(document_id='user:alice', revision='AB' * 16)
+        self.assertEqual(Change.objects.get(pk=change.pk).revision, 'ab' * 16)
+        self.assertEqual(Change.objects.get(revision='ab' * 16).pk, change.pk)
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT revision FROM sofa_change WHERE id = %s', [change.pk])
+            self.assertEqual(bytes(cursor.fetchone()[0]), bytes.fromhex('ab' * 16))
+
+
+class BulkDocsRetryTest(SofaTestCase):
+    def test_retry(self):
+        User.objects.create(username='user0')
+        docs = [{"_id": f"user:user{i}", "_rev": f"1-{i:032x}", "first_name": f"name{i}"} for i in range(20)]
+        docs.append({"_id": "user:user0", "_rev": "2-" + "a" * 32, "_deleted": True})
+        body = {"docs": docs, "new_edits": False}
+        with self.captureOnCommitCallbacks(execute=True):
+            saved = self.post_json('/sofa/db/_bulk_docs', body).json()
+        changes = Change.objects.count()
+
+        # the revisions of a retried push are all found with a single query, nothing is saved again
+        with self.assertNumQueries(2):
+            retried = self.post_json('/sofa/db/_bulk_docs', body).json()
+        self.assertEqual(retried, saved)
+        self.assertEqual(Change.objects.count(), changes)
+        self.assertFalse(User.objects.filter(username='user0').exists())
+
+
+@override_settings(SOFA_REPLICATION_HISTORY_LIMIT=3)
+class ReplicationLogTest(SofaTestCase):
+    def put_checkpoint(self, prefix, session_id, last_seq):
+        body = {'version': 1, 'replicator': 'pouchdb', 'session_id': session_id, 'last_seq': last_seq}
+        return self.client.put(f'/{prefix}/db/_local/replication', json.dumps(body), content_type='application/json')
+
+    def test_checkpoints(self):
+        for prefix in PREFIXES:
+            with self.subTest(prefix=prefix):
+                ReplicationLog.objects.all().delete()
+                self.assertEqual(self.client.get(f'/{prefix}/db/_local/replication').status_code, 404)
+                for session in range(5):
+                    for seq in range(3):
+                        self.assertEqual(self.put_checkpoint(prefix, f's{session}', session * 10 + seq).status_code, 201)
+                # a session has a single entry, only the latest sessions are kept
+                self.assertEqual(ReplicationHistory.objects.count(), 3)
+
+                # s2 is the oldest session kept: its checkpoint makes it the latest one, s3 is pruned next
+                self.put_checkpoint(prefix, 's2', 50)
+                self.put_checkpoint(prefix, 's5', 60)
+                with self.assertNumQueries(1):
+                    response = self.client.get(f'/{prefix}/db/_local/replication')
+                self.assertEqual(response.json()['last_seq'], 60)
+                self.assertEqual([(h['session_id'], h['last_seq']) for h in response.json()['history']], [('s5', 60), ('s2', 50), ('s4', 42)])
+
+                etag = response['ETag']
+                self.assertEqual(self.client.get(f'/{prefix}/db/_local/replication', HTTP_IF_NONE_MATCH=etag).status_code, 304)
+                self.put_checkpoint(prefix, 's5', 61)
+                self.assertEqual(self.client.get(f'/{prefix}/db/_local/replication', HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+
+class ChangesTest(SofaTestCase):
+    def test_empty_page(self):
+        User.objects.create(username='alice')
+        for prefix in PREFIXES:
+            with self.subTest(prefix=prefix):
+                # the cached update_seq can be behind the since of a client: it never goes back
+                changes = self.get_json(self.client.get(f'/{prefix}/db/_changes?since=1000'))
+                self.assertEqual(changes, {"results": [], "last_seq": "1000"})
+
+    def test_include_docs(self):
+        for i in range(3):
+            User.objects.create(username=f'user{i}')
+        User.objects.get(username='user1').delete()
+        for prefix in PREFIXES:
+            with self.subTest(prefix=prefix):
+                changes = self.get_json(self.client.get(f'/{prefix}/db/_changes?since=0&include_docs=true'))
+                docs = {row['id']: row['doc'] for row in changes['results']}
+                self.assertEqual(docs['user:user0']['username'], 'user0')
+                self.assertEqual(docs['user:user0']['_rev'], changes['results'][0]['changes'][0]['rev'])
+                self.assertEqual(set(docs['user:user1']), {'_id', '_rev', '_deleted'})
+                changes = self.get_json(self.client.get(f'/{prefix}/db/_changes?since=0'))
+                self.assertNotIn('doc', changes['results'][0])
+
+
+class AllDocsTest(SofaTestCase):
+    def setUp(self):
+        super().setUp()
+        for i in range(7):
+            User.objects.create(username=f'user{i}')
+        User.objects.get(username='user3').delete()
+
+    def get_ids(self, prefix, **params):
+        body = self.get_json(self.client.get(f'/{prefix}/db/_all_docs', params))
+        self.assertEqual(body['total_rows'], 6)
+        return [row['id'] for row in body['rows']]
+
+    def test_keys_range(self):
+        for prefix in PREFIXES:
+            with self.subTest(prefix=prefix):
+                self.assertEqual(self.get_ids(prefix, limit=3, skip=1), ['user:user1', 'user:user2', 'user:user4'])
+                self.assertEqual(self.get_ids(prefix, startkey='"user:user1"', endkey='"user:user5"'), ['user:user1', 'user:user2', 'user:user4', 'user:user5'])
+                self.assertEqual(self.get_ids(prefix, startkey='"user:user1"', endkey='"user:user5"', inclusive_end='false'), ['user:user1', 'user:user2', 'user:user4'])
+                self.assertEqual(self.get_ids(prefix, startkey='"user:user5"', endkey='"user:user1"', descending='true', limit=2), ['user:user5', 'user:user4'])
+                self.assertEqual(self.get_ids(prefix, startkey='"user:user5"', endkey='"user:user1"', descending='true', inclusive_end='false'), ['user:user5', 'user:user4', 'user:user2'])
+
+    def test_include_docs(self):
+        for prefix in PREFIXES:
+            with self.subTest(prefix=prefix):
+                body = self.get_json(self.client.get(f'/{prefix}/db/_all_docs', {'include_docs': 'true', 'limit': 2}))
+                self.assertEqual([(row['id'], row['doc']['username'], row['doc']['_rev']) for row in body['rows']], [
+                    ('user:user0', 'user0', body['rows'][0]['value']['rev']),
+                    ('user:user1', 'user1', body['rows'][1]['value']['rev']),
+                ])
+
+
+class DocumentTest(SofaTestCase):
+    def test_etag(self):
+        User.objects.create(username='alice')
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.get('/sofa/db/user:alice?latest=true')
+        etag = response['ETag']
+        self.assertEqual(etag, f'"{response.json()[0]["_rev"]}"')
+        # the latest change of the document only
+        with self.assertNumQueries(1):
+            self.assertEqual(self.client.get('/sofa/db/user:alice?latest=true', HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        User.objects.filter(username='alice').get().save()
+        self.assertEqual(self.client.get('/sofa/db/user:alice?latest=true', HTTP_IF_NONE_MATCH=etag).status_code, 200)
+        self.assertEqual(self.client.get('/sofa/db/user:nobody?latest=true').status_code, 404)
+
+
+class ShardsTest(SofaTestCase):
+    def setUp(self):
+        super().setUp()
+        GroupsDocument.Meta.shards = 4
+        self.addCleanup(delattr, GroupsDocument.Meta, 'shards')
+
+    def test_shards(self):
+        groups = [Group.objects.create(name=f'group{i}') for i in range(10)]
+        Change.objects.all().delete()
+        GroupsDocument.add_revision()
+        changes = self.get_json(self.client.get('/sofa/db/_changes'))
+        ids = [row['id'] for row in changes['results']]
+        self.assertEqual(ids, ['groups:0', 'groups:1', 'groups:2', 'groups:3'])
+
+        # a change of a group only changes its shard
+        group = groups[5]
+        group.name = 'changed'
+        group.save()
+        changes = self.get_json(self.client.get(f'/sofa/db/_changes?since={changes["last_seq"]}'))
+        self.assertEqual([row['id'] for row in changes['results']], [f'groups:{group.pk % 4}'])
+
+        for prefix in PREFIXES:
+            with self.subTest(prefix=prefix):
+                body = self.get_json(self.post_json(f'/{prefix}/db/_bulk_get?latest=true', {"docs": [{"id": doc_id} for doc_id in ids]}))
+                names = {result['id']: {group['name'] for group in result['docs'][0]['ok']['value']} for result in body['results']}
+                self.assertEqual(names, {f'groups:{shard}': {g.name for g in Group.objects.all() if g.pk % 4 == shard} for shard in range(4)})
+
+        response = self.client.get(f'/sofa/db/groups:{group.pk % 4}?latest=true')
+        self.assertIn('changed', [group['name'] for group in response.json()[0]['value']])
+        for doc_id in ('groups:4', 'groups:x', 'groups'):
+            self.assertEqual(self.client.get(f'/sofa/db/{doc_id}?latest=true').status_code, 404)
+
+    def test_check_shards(self):
+        GroupsDocument.check_shards()
+        GroupsDocument.Meta.replica_field = 'name'
+        self.addCleanup(delattr, GroupsDocument.Meta, 'replica_field')
+        with self.assertRaises(ImproperlyConfigured):
+            GroupsDocument.check_shards()
+
+
+class RevsLimitTest(SofaTestCase):
+    def get_revisions(self, prefix='sofa'):
+        body = self.get_json(self.post_json(f'/{prefix}/db/_bulk_get?latest=true&revs=true', {"docs": [{"id": "user:alice"}, {"id": "user:bob"}]}))
+        return {result['id']: result['docs'][0]['ok']['_revisions'] for result in body['results']}
+
+    def test_limit(self):
+        alice = User.objects.create(username='alice')
+        User.objects.create(username='bob')
+        for i in range(9):
+            alice.first_name = str(i)
+            alice.save()
+        revisions = self.get_revisions()
+        self.assertEqual((revisions['user:alice']['start'], len(revisions['user:alice']['ids'])), (10, 10))
+
+        with self.settings(SOFA_REVS_LIMIT=3):
+            for prefix in PREFIXES:
+                with self.subTest(prefix=prefix):
+                    limited = self.get_revisions(prefix)
+                    # the latest revisions, start is still the count of all of them
+                    self.assertEqual(limited['user:alice'], {"ids": revisions['user:alice']['ids'][:3], "start": 10})
+                    self.assertEqual(limited['user:bob'], revisions['user:bob'])
+
+        UserDocument.Meta.revs_limit = 1
+        self.addCleanup(delattr, UserDocument.Meta, 'revs_limit')
+        self.assertEqual(self.get_revisions()['user:alice'], {"ids": revisions['user:alice']['ids'][:1], "start": 10})
+
+    def test_limit_by_database(self):
+        with self.settings(SOFA_REVS_LIMIT={'db': 3}):
+            self.assertEqual(UserDocument.get_revs_limit(), 3)
+        with self.settings(SOFA_REVS_LIMIT={'other': 3}):
+            self.assertEqual(UserDocument.get_revs_limit(), 1000)
+        with self.settings(SOFA_REVS_LIMIT={'db': None}):
+            self.assertIsNone(UserDocument.get_revs_limit())
+
+
+class DatabasesTest(SofaTestCase):
+    def setUp(self):
+        GroupsDocument.Meta.database = 'office'
+        loader.load()
+        self.addCleanup(loader.load)
+        self.addCleanup(delattr, GroupsDocument.Meta, 'database')
+        super().setUp()
+        User.objects.create(username='alice')
+        Group.objects.create(name='group')
+
+    def test_feeds(self):
+        for prefix in PREFIXES:
+            with self.subTest(prefix=prefix):
+                self.assertEqual(self.client.get(f'/{prefix}/other/_changes').status_code, 404)
+                db = self.get_json(self.client.get(f'/{prefix}/db/_changes?since=0'))
+                office = self.get_json(self.client.get(f'/{prefix}/office/_changes?since=0'))
+                self.assertEqual([row['id'] for row in db['results']], ['user:alice'])
+                self.assertEqual([row['id'] for row in office['results']], ['groups'])
+
+                for db_name, doc_id in (('db', 'user:alice'), ('office', 'groups')):
+                    body = self.get_json(self.post_json(f'/{prefix}/{db_name}/_bulk_get?latest=true', {'docs': [{'id': 'groups'}, {'id': 'user:alice'}]}))
+                    self.assertEqual([result['id'] for result in body['results']], [doc_id])
+                    body = self.get_json(self.client.get(f'/{prefix}/{db_name}/_all_docs'))
+                    self.assertEqual((body['total_rows'], [row['id'] for row in body['rows']]), (1, [doc_id]))
+
+                rev = office['results'][0]['changes'][0]['rev']
+                self.assertEqual(self.post_json(f'/{prefix}/db/_revs_diff', {'groups': [rev]}).json(), {'groups': {'missing': [rev]}})
+                self.assertEqual(self.post_json(f'/{prefix}/office/_revs_diff', {'groups': [rev]}).json(), {})
+
+        self.assertEqual(self.client.get('/sofa/other/').status_code, 404)
+        self.assertEqual(self.client.get('/sofa/office/user:alice?latest=true').status_code, 404)
+
+    def test_update_seq(self):
+        db_seq = self.client.get('/sofa/db/').json()['update_seq']
+        with self.captureOnCommitCallbacks(execute=True):
+            group = Group.objects.create(name='other')
+        self.assertEqual(self.client.get('/sofa/office/').json()['update_seq'], Change.objects.latest('pk').pk)
+        self.assertEqual(self.client.get('/sofa/db/').json()['update_seq'], db_seq)
+
+
+class SnapshotTest(SofaTestCase):
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        snapshot_settings = self.settings(SOFA_SNAPSHOT_DIR=directory.name)
+        snapshot_settings.enable()
+        self.addCleanup(snapshot_settings.disable)
+        UserDocument.Meta.snapshot = True
+        self.addCleanup(delattr, UserDocument.Meta, 'snapshot')
+
+    def get_lines(self, data):
+        return [json.loads(line) for line in gzip.decompress(data).splitlines()]
+
+    def test_ranges(self):
+        self.assertEqual(self.client.get('/sofa/db/_snapshot').status_code, 404)
+        for i in range(20):
+            User.objects.create(username=f'user{i}')
+        Group.objects.create(name='group')
+        call_command('sofa_snapshot', stdout=io.StringIO())
+
+        for prefix in PREFIXES:
+            with self.subTest(prefix=prefix):
+                response = self.client.get(f'/{prefix}/db/_snapshot')
+                data = read_response(response)
+                # the header, then the users: the groups aren't part of the snapshot
+                lines = self.get_lines(data)
+                self.assertEqual(len(lines), 21)
+                self.assertEqual({line['_id'] for line in lines[1:]}, {f'user:user{i}' for i in range(20)})
+                self.assertEqual(response['Accept-Ranges'], 'bytes')
+
+                # an interrupted download is resumed
+                etag = response['ETag']
+                resumed = self.client.get(f'/{prefix}/db/_snapshot', HTTP_RANGE='bytes=100-', HTTP_IF_RANGE=etag)
+                self.assertEqual(resumed.status_code, 206)
+                self.assertEqual(resumed['Content-Range'], f'bytes 100-{len(data) - 1}/{len(data)}')
+                self.assertEqual(data[:100] + read_response(resumed), data)
+                self.assertEqual(read_response(self.client.get(f'/{prefix}/db/_snapshot', HTTP_RANGE='bytes=-10')), data[-10:])
+                # another snapshot than the one of the download: it starts again
+                self.assertEqual(self.client.get(f'/{prefix}/db/_snapshot', HTTP_RANGE='bytes=100-', HTTP_IF_RANGE='"db-1"').status_code, 200)
+                unsatisfiable = self.client.get(f'/{prefix}/db/_snapshot', HTTP_RANGE=f'bytes={len(data)}-')
+                self.assertEqual(unsatisfiable.status_code, 416)
+                self.assertEqual(unsatisfiable['Content-Range'], f'bytes */{len(data)}')
+
+
+@override_settings(SOFA_DOCUMENTS_CHUNK_SIZE=10)
+class CompressionTest(SofaTestCase):
+    def test_gzip(self):
+        for i in range(30):
+            User.objects.create(username=f'user{i}')
+        docs = {"docs": [{"id": f"user:user{i}"} for i in range(30)]}
+        for prefix in PREFIXES:
+            with self.subTest(prefix=prefix):
+                response = self.post_json(f'/{prefix}/db/_bulk_get?latest=true', docs, HTTP_ACCEPT_ENCODING='gzip, br;q=0')
+                self.assertEqual(response['Content-Encoding'], 'gzip')
+                self.assertIn('Accept-Encoding', response['Vary'])
+                chunks = read_chunks(response)
+                body = gzip.decompress(b''.join(chunks))
+                self.assertEqual(len(json.loads(body)['results']), 30)
+                # every chunk of documents is flushed: a client parses it before the end of the response
+                partial = zlib.decompressobj(16 + zlib.MAX_WBITS).decompress(b''.join(chunks[:-1]))
+                self.assertTrue(body.startswith(partial))
+                self.assertIn(b'"user:user0"', partial)
+
+                response = self.post_json(f'/{prefix}/db/_bulk_get?latest=true', docs)
+                self.assertFalse(response.has_header('Content-Encoding'))
+                self.assertEqual(len(self.get_json(response)['results']), 30)
+
+                response = self.client.get(f'/{prefix}/db/_all_docs?include_docs=true', HTTP_ACCEPT_ENCODING='gzip')
+                self.assertEqual(len(json.loads(gzip.decompress(read_response(response)))['rows']), 30)
+
+
+@override_settings(SOFA_ADMISSION_LIMITS={'bulk_get': 1}, SOFA_ADMISSION_QUEUE_TIMEOUT=0.01, SOFA_ADMISSION_RETRY_AFTER=3)
+class AdmissionTest(SofaTestCase):
+    def bulk_get(self, prefix, **extra):
+        return self.post_json(f'/{prefix}/db/_bulk_get?latest=true', {"docs": [{"id": "user:alice"}]}, **extra)
+
+    def test_limits(self):
+        User.objects.create(username='alice')
+        for prefix in PREFIXES:
+            with self.subTest(prefix=prefix):
+                # a streaming response holds its slot until it is sent
+                held = self.bulk_get(prefix)
+                rejected = self.bulk_get(prefix, REMOTE_ADDR='10.0.0.2')
+                self.assertEqual(rejected.status_code, 503)
+                self.assertEqual(rejected['Retry-After'], '3')
+                read_response(held)
+                read_response(self.bulk_get(prefix, REMOTE_ADDR='10.0.0.2'))
+
+                with self.settings(SOFA_ADMISSION_LIMITS={'bulk_get': 2}, SOFA_ADMISSION_CLIENT_LIMIT=1):
+                    held = self.bulk_get(prefix)
+                    self.assertEqual(self.bulk_get(prefix).status_code, 429)
+                    # a response closed before the end frees its slot
+                    held.close()
+                    read_response(self.bulk_get(prefix))